@@ -0,0 +1,297 @@
+import getopt
+import http.client
+import http.server
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+# Benchmarks of the ingest and serve paths, with synthetic data, temporary
+# directories and servers on loopback only, so it can run anywhere before
+# deploying to the Pi:
+#   python bench.py [-n lines] [-c clients] [-r requests per client]
+# Benchmarks whose dependencies (pyserial etc. for ivt490d, aioesphomeapi
+# for slimmelezer) aren't installed are skipped.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ivt490_server"))
+import defa_packet
+import ivt490
+import ivt490bin
+import metrics
+
+# Values that show up in the uptime column, see ivt490.recordToDict
+JUNK_UPTIMES = ["32767", "-\xf8", "-32767"]
+
+# A line as ivt490d logs it: time and 37 fields, with some plausible
+# variation in the fields the readers use and junk uptimes now and then.
+def ivt490Line(t, rnd):
+    fields = [0] * ivt490bin.NFIELDS
+    fields[0] = rnd.randrange(0, 30000)
+    fields[1] = 200 + rnd.randrange(-100, 150) # gt1
+    fields[2] = rnd.randrange(-150, 250)       # gt2, outdoor
+    fields[3:6] = [480 + rnd.randrange(20), 490 + rnd.randrange(20), 400 + rnd.randrange(20)]
+    fields[6] = -512
+    fields[7] = 200 + rnd.randrange(400)       # gt6
+    fields[8] = -512
+    compressor = rnd.random() < 0.5
+    fields[13] = int(compressor)
+    fields[16] = 1
+    fields[17] = int(compressor)
+    fields[20:27] = [202, 217, 232, 247, 495, 520, 545]
+    fields[22] = 200 + rnd.randrange(150)       # estimated temperature
+    fields[27:31] = [207, 232, 257, 330]
+    fields[31] = 120
+    fields[33] = rnd.choice([0, 0, 0, 300, 600])  # electric heater sum
+    fields[35] = fields[33] // 2
+    fields[36] = fields[33] - fields[35]
+    parts = [str(t)] + [str(v) for v in fields]
+    if rnd.random() < 0.05:
+        parts[1] = rnd.choice(JUNK_UPTIMES)
+    return ";".join(parts)
+
+def ivt490Lines(n, start, interval=60, seed=1):
+    rnd = random.Random(seed)
+    return [ivt490Line(round(start + i * interval, 2), rnd) for i in range(n)]
+
+# Packets in the layout defa_packet.PACKET decodes, from a few chargers.
+def defaPackets(n, serials=("437704C1A", "437704C1B"), seed=1):
+    rnd = random.Random(seed)
+    millis = int(time.time() * 1000)
+    packets = []
+    for i in range(n):
+        amps = [rnd.randrange(0, 16000) for _ in range(3)]
+        packets.append(defa_packet.PACKET.pack(b"L4", serials[i % len(serials)].encode(), millis + i * 1000,
+                                               amps[0], amps[1], amps[2], b"1.2.3   "))
+    return packets
+
+# State updates as aioesphomeapi delivers them to slimmelezer, for a P1
+# meter's power sensors and one entity not recorded.
+def esphomeStates(n, seed=1):
+    rnd = random.Random(seed)
+    states = []
+    for i in range(n):
+        key = i % 5
+        value = 1.0 + rnd.random() if key < 4 else float(i // 5)
+        states.append(SimpleNamespace(key=key, state=value, missing_state=False))
+    return states
+
+ESPHOME_KEYS = {
+    0: ("power_consumed", "kW"),
+    1: ("power_consumed_phase_1", "kW"),
+    2: ("power_consumed_phase_2", "kW"),
+    3: ("power_consumed_phase_3", "kW"),
+    4: ("energy_consumed_luxembourg", "kWh"),
+}
+
+def report(name, count, seconds, unit="items"):
+    print(f"{name:40} {count / seconds:12.0f} {unit}/s ({count} in {seconds:.3f} s)")
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+def percentile(sortedValues, p):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * p / 100))]
+
+def benchParsing(lines, packets):
+    def parseCsv():
+        for line in lines:
+            try:
+                ivt490.lineToDict(line)
+            except (IndexError, ValueError):
+                pass
+    report("ivt490 CSV line to dict", len(lines), timed(parseCsv), "lines")
+
+    def encodeBinary():
+        for line in lines:
+            ivt490bin.encodeLine(line)
+    report("ivt490 CSV line to binary record", len(lines), timed(encodeBinary), "lines")
+
+    records = [ivt490bin.encodeLine(line) for line in lines]
+    def decodeBinary():
+        for rec in records:
+            ivt490bin.decodeToLine(rec)
+    report("ivt490 binary record to CSV line", len(records), timed(decodeBinary), "records")
+
+    decoder = defa_packet.Decoder()
+    def decodePackets():
+        for packet in packets:
+            decoder.decode(packet)
+    report("DEFA packet decode", len(packets), timed(decodePackets), "packets")
+
+def benchMetrics(n):
+    registry = metrics.Registry()
+    counter = registry.counter("bench_total", "Benchmark counter")
+    histogram = registry.histogram("bench_seconds", "Benchmark histogram", ("path", )).labels("/")
+    def count():
+        for _ in range(n):
+            counter.inc()
+    report("metrics counter increment", n, timed(count), "updates")
+    def observe():
+        for i in range(n):
+            histogram.observe(i * 1e-6)
+    report("metrics histogram observation", n, timed(observe), "updates")
+
+def benchWriters(tmpdir, lines):
+    try:
+        import ivt490d
+    except ImportError as e:
+        print(f"Skipping ivt490d writers: {e}")
+        return
+    data = [line + "\n" for line in lines]
+    size = sum(len(line) for line in data)
+    for flushInterval, fsync in ((0, False), (5, False), (5, True)):
+        writer = ivt490d.Writer(os.path.join(tmpdir, "bench.log"), flush_interval=flushInterval, fsync=fsync)
+        def write():
+            for line in data:
+                writer.write(line)
+            writer.close()
+        seconds = timed(write)
+        name = f"ivt490d Writer, flush {flushInterval} s{', fsync' if fsync else ''}"
+        report(name, len(data), seconds, "lines")
+        print(f"{'':40} {size / seconds / 1e6:12.1f} MB/s")
+        os.remove(os.path.join(tmpdir, "bench.log"))
+
+def benchSlimmelezer(tmpdir, states):
+    try:
+        import slimmelezer
+    except ImportError as e:
+        print(f"Skipping slimmelezer: {e}")
+        return
+    for mode in ("tick", "swingingdoor"):
+        deviceOpts = { k: slimmelezer.opts[k] for k in slimmelezer.DEVICE_OPTS if k in slimmelezer.opts }
+        deviceOpts.update(host="bench", recordMode=mode, outputFile=os.path.join(tmpdir, f"slimmelezer-{mode}.log"))
+        device = slimmelezer.Device(deviceOpts)
+        connection = slimmelezer.Connection(device)
+        connection.keyLookup = ESPHOME_KEYS
+        def update():
+            for state in states:
+                connection.change_callback(state)
+            device.flushCompressors()
+            slimmelezer.fileWriter.close()
+        report(f"slimmelezer state updates, {mode}", len(states), timed(update), "updates")
+
+# Runs clients concurrent keep-alive clients, each making requests GETs
+# of the paths in turn, and reports the latency percentiles per path.
+def benchHttp(name, port, paths, clients, requests):
+    latencies = { path: [] for path in paths }
+    lock = threading.Lock()
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine = { path: [] for path in paths }
+        for i in range(requests):
+            path = paths[i % len(paths)]
+            start = time.perf_counter()
+            connection.request("GET", path, headers={ "Accept-Encoding": "gzip" })
+            response = connection.getresponse()
+            response.read()
+            mine[path].append(time.perf_counter() - start)
+            if response.status != 200:
+                raise Exception(f"{path} returned {response.status}")
+        connection.close()
+        with lock:
+            for path, values in mine.items():
+                latencies[path] += values
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    report(f"{name} HTTP, {clients} clients", clients * requests, seconds, "requests")
+    for path, values in latencies.items():
+        values.sort()
+        if values:
+            print(f"  {path[:38]:38} p50 {percentile(values, 50) * 1000:7.2f} ms  p99 {percentile(values, 99) * 1000:7.2f} ms")
+
+def serve(handler):
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def benchIvt490Server(tmpdir, clients, requests):
+    import server
+    # two days of readings up to now, one a minute
+    now = time.time()
+    start = datetime.fromtimestamp(now - 86400).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    files = {}
+    for line in ivt490Lines(int((now - start) // 60), start):
+        day = datetime.fromtimestamp(float(line.split(";", 1)[0])).strftime("%Y%m%d")
+        files.setdefault(day, []).append(line)
+    for day, lines in files.items():
+        with open(os.path.join(tmpdir, day + ".dat"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    server.basepath = tmpdir
+    server.feedpath = os.path.join(tmpdir, "no.feed")
+    server.MyHandler.feed = server.FeedReader(server.feedpath)
+    server.MyHandler.log_message = lambda *args: None
+    httpd = serve(server.MyHandler)
+    try:
+        benchHttp("ivt490 server", httpd.server_address[1],
+                  ["/", f"/history?from={now - 3600:.0f}", f"/history?from={now - 86400:.0f}&step=600", "/metrics"], clients, requests)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def benchDefaServer(packets, clients, requests):
+    import defa_lb_server
+    for packet in packets:
+        defa_lb_server.handle_packet(packet)
+    defa_lb_server.SimpleHTTPRequestHandler.log_message = lambda *args: None
+    httpd = serve(defa_lb_server.SimpleHTTPRequestHandler)
+    try:
+        benchHttp("defa_lb_server", httpd.server_address[1],
+                  ["/", "/chargers", "/history?window=3600", "/stats", "/metrics"], clients, requests)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def usage():
+    print(f"{sys.argv[0]} [-h] [-n lines] [-c clients] [-r requests per client]")
+    print(f"\t-n  : number of lines, packets and state updates to process (default 100000)")
+    print(f"\t-c  : number of concurrent HTTP clients (default 8)")
+    print(f"\t-r  : number of requests per HTTP client (default 200)")
+    print(f"\t-h  : show this help")
+
+def main():
+    n = 100000
+    clients = 8
+    requests = 200
+    optss, args = getopt.getopt(sys.argv[1:], 'hn:c:r:')
+    for o, a in optss:
+        if o == "-n":
+            n = int(a)
+        elif o == "-c":
+            clients = int(a)
+        elif o == "-r":
+            requests = int(a)
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    lines = ivt490Lines(n, time.time() - n * 60)
+    packets = defaPackets(n)
+    states = esphomeStates(n)
+    tmpdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        benchParsing(lines, packets)
+        benchMetrics(n)
+        benchWriters(tmpdir, lines)
+        benchSlimmelezer(tmpdir, states)
+        serverdir = os.path.join(tmpdir, "ivt490")
+        os.mkdir(serverdir)
+        benchIvt490Server(serverdir, clients, requests)
+        benchDefaServer(packets[:10000], clients, requests)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import socket
 import struct
-from datetime import datetime, timedelta
+from defa_packet import Decoder, timestamp_utc
 
 # Multicast group details
 MCAST_GRP = "234.222.250.1"
@@ -18,8 +18,6 @@ sock.bind(('', MCAST_PORT))
 # Tell the kernel that we are a multicast socket
 sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack("4sl", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY))
 
-Epoch = datetime(1970, 1, 1)
-
 def print_unknown(data, size, offs = 0):
     print("size = %d, offset = %d" % (size, offs))
     i = offs
@@ -29,31 +27,28 @@ def print_unknown(data, size, offs = 0):
         print("- offset %d: %d" % (i, num))
         i += size
 
+decoder = Decoder()
+
 # Receive the data, note that this is a blocking call
 while True:
-    data, _ = sock.recvfrom(10240)
-
-    # L437704C1A4
-    first = data[0:2].decode("ascii")
-    serial = data[2:11].decode("ascii")
-    millis = int.from_bytes(data[11:19], "little")
-    timestamp = Epoch + timedelta(milliseconds = millis)
-    unknown = data[19:30]
-    version = data[30:38].decode("ascii")
-
-    phase_1 = int.from_bytes(unknown[1:3], "little") / 1000.0
-    phase_2 = int.from_bytes(unknown[4:6], "little") / 1000.0
-    phase_3 = int.from_bytes(unknown[7:9], "little") / 1000.0
+    reading = decoder.receive(sock)
+    if reading is None:
+        print("--- malformed packet")
+        continue
 
     print("---")
-    print("first two: %s" % (first, ))
-    print("serial   : %s" % (serial, ))
-    print("time UTC : %s" % (timestamp, ))
-    print("version  : %s" % (version, ))
-    print("phase 1  : %.2f" % (phase_1, ))
-    print("phase 2  : %.2f" % (phase_2, ))
-    print("phase 3  : %.2f" % (phase_3, ))
+    print("first two: %s" % (reading.first, ))
+    print("serial   : %s" % (reading.serial, ))
+    print("time UTC : %s" % (timestamp_utc(reading.millis), ))
+    print("version  : %s" % (reading.version, ))
+    print("phase 1  : %.2f" % (reading.phase1_amps, ))
+    print("phase 2  : %.2f" % (reading.phase2_amps, ))
+    print("phase 3  : %.2f" % (reading.phase3_amps, ))
+    stats = decoder.stats()
+    print("packets  : %d (%d malformed, %.1f/s, %.1f us to decode)" % (
+        stats["packets"], stats["malformed"], stats["packets_per_second"], stats["mean_decode_us"]))
     print("-")
+    #unknown = decoder.buffer[19:30]
     #print_unknown(unknown, 1)
     #print_unknown(unknown, 2)
     #print_unknown(unknown, 4)
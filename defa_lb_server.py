@@ -1,27 +1,42 @@
 import socket
 import struct
-from datetime import datetime, timedelta
+from array import array
+from collections import deque
+from contextlib import nullcontext
+from urllib.parse import urlsplit, parse_qs
+import asyncio
+import getopt
 import http.server
 import json
+import math
+import sys
 import threading
+import time
+import zlib
+import metrics
+from defa_packet import Decoder, timestamp_utc
 
 # Multicast group details
 MCAST_GRP = "234.222.250.1"
 MCAST_PORT = 57082
+HTTP_PORT = 8000
 
-# Create a UDP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+def open_socket(groups=(MCAST_GRP, ), interfaces=("0.0.0.0", )):
+    # Create a UDP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 
-# Allow multiple sockets to use the same PORT number
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Allow multiple sockets to use the same PORT number
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-# Bind to the port that we know will receive multicast data
-sock.bind(('', MCAST_PORT))
+    # Bind to the port that we know will receive multicast data
+    sock.bind(('', MCAST_PORT))
 
-# Tell the kernel that we are a multicast socket
-sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack("4sl", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY))
-
-Epoch = datetime(1970, 1, 1)
+    # Tell the kernel that we are a multicast socket, once per group and interface
+    for group in groups:
+        for interface in interfaces:
+            mreq = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton(interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
 
 class SharedData:
     def __init__(self, data):
@@ -47,18 +62,330 @@ empty_readings = {
 # Shared readings, updated by the reader loop and served as JSON by the HTTP server.
 shared_readings = SharedData(empty_readings)
 
+# Decodes the packets and keeps the latest reading per charger.
+decoder = Decoder()
+
+def readings_dict(reading):
+    return {
+        "timestamp_utc": str(timestamp_utc(reading.millis)),
+        "serial": reading.serial,
+        "phase1_amps": reading.phase1_amps,
+        "phase2_amps": reading.phase2_amps,
+        "phase3_amps": reading.phase3_amps
+    }
+
+# Number of readings kept per charger, 6 hours at one packet per second.
+HISTORY_SIZE = 6 * 3600
+PHASES = ("phase1_amps", "phase2_amps", "phase3_amps")
+PERCENTILES = (50, 90, 99)
+
+# Preallocated ring buffer of receive times and phase currents for one charger.
+class History:
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.count = 0
+        self.times = array("d", bytes(8 * size))
+        self.phases = [array("d", bytes(8 * size)) for _ in PHASES]
+
+    def append(self, t, amps):
+        i = self.count % self.size
+        self.times[i] = t
+        for p, a in zip(self.phases, amps):
+            p[i] = a
+        self.count += 1
+
+    # Logical index (0 = first reading ever) of the first reading at or after t.
+    def find(self, t):
+        lo = max(0, self.count - self.size)
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[mid % self.size] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Copies the readings at or after from_time out of the buffer, oldest first,
+    # as (times, [phase 1, phase 2, phase 3]).
+    def window(self, from_time):
+        first = self.find(from_time)
+        a = first % self.size
+        b = self.count % self.size
+        if first == self.count:
+            return array("d"), [array("d") for _ in PHASES]
+        if a < b:
+            return self.times[a:b], [p[a:b] for p in self.phases]
+        return self.times[a:] + self.times[:b], [p[a:] + p[:b] for p in self.phases]
+
+def percentile(sorted_values, pct):
+    return sorted_values[round(pct / 100.0 * (len(sorted_values) - 1))]
+
+# Summary of the window's values. min, max and sum run over the array
+# itself; only the percentiles need a sorted copy.
+def stats(values):
+    if len(values) == 0:
+        return None
+    result = {
+        "min": min(values),
+        "max": max(values),
+        "mean": sum(values) / len(values)
+    }
+    s = sorted(values)
+    for pct in PERCENTILES:
+        result["p%d" % (pct, )] = percentile(s, pct)
+    return result
+
+# Histories per charger serial, updated by the reader loop.
+class SharedHistory:
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.histories = {}
+        self.lock = threading.Lock()
+
+    def add(self, serial, t, amps):
+        with self.lock:
+            history = self.histories.get(serial)
+            if history is None:
+                history = self.histories[serial] = History(self.size)
+            history.append(t, amps)
+
+    # Returns {serial: (times, phases)} for the readings of the last window seconds.
+    def windows(self, window, serial=None):
+        from_time = time.time() - window
+        with self.lock:
+            return {s: h.window(from_time) for s, h in self.histories.items() if serial is None or s == serial}
+
+shared_history = SharedHistory()
+
+# Readings queued per streaming client before the oldest are dropped.
+STREAM_QUEUE_SIZE = 100
+# Seconds between keep-alive comments on idle streams.
+STREAM_KEEPALIVE = 15
+
+# A streaming client's bounded queue. put never blocks; when the queue is
+# full the oldest reading is dropped, so a slow client can't stall the reader.
+class Subscriber:
+    def __init__(self, serial=None, size=STREAM_QUEUE_SIZE):
+        self.serial = serial
+        self.queue = deque(maxlen=size)
+        self.event = threading.Event()
+        self.dropped = 0
+
+    def put(self, item):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            STREAM_DROPPED.inc()
+        self.queue.append(item)
+        self.event.set()
+
+    # Waits for readings and returns them, or an empty list on timeout.
+    def get(self, timeout):
+        self.event.wait(timeout)
+        self.event.clear()
+        items = []
+        while self.queue:
+            items.append(self.queue.popleft())
+        return items
+
+# Same as Subscriber, for clients served from the asyncio event loop.
+class AsyncSubscriber(Subscriber):
+    def __init__(self, serial=None, size=STREAM_QUEUE_SIZE):
+        super().__init__(serial, size)
+        self.event = asyncio.Event()
+
+    async def get(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+        items = list(self.queue)
+        self.queue.clear()
+        return items
+
+# Fans out each reading to the streaming clients.
+class Broadcaster:
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.seqs = {} # serial -> readings published
+
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, readings):
+        serial = readings["serial"]
+        seq = self.seqs.get(serial, 0) + 1
+        self.seqs[serial] = seq
+        if not self.subscribers:
+            return
+        # encode once as a server-sent event. The id is <serial>/<seq> with a
+        # sequence per charger, so that clients of one or all chargers can
+        # detect drops as gaps in it.
+        event = b"id: %s/%d\ndata: %s\n\n" % (serial.encode(), seq, json.dumps(readings).encode())
+        with self.lock:
+            for subscriber in self.subscribers:
+                if subscriber.serial is None or subscriber.serial == serial:
+                    subscriber.put(event)
+
+broadcaster = Broadcaster()
+
+# Packet counts are kept by the decoder anyway, so they're read when scraped.
+metrics.counter_func("defa_packets_total", "Packets received", lambda: decoder.packets)
+metrics.counter_func("defa_malformed_packets_total", "Packets that could not be decoded", lambda: decoder.malformed)
+metrics.counter_func("defa_decode_seconds_total", "Time spent decoding packets", lambda: decoder.decode_ns / 1e9)
+metrics.gauge_func("defa_chargers", "Chargers seen", lambda: len(decoder.latest))
+metrics.gauge_func("defa_stream_clients", "Clients connected to /stream", lambda: len(broadcaster.subscribers))
+STREAM_DROPPED = metrics.counter("defa_stream_dropped_events_total", "Events dropped for slow /stream clients")
+ENDPOINTS = ("/", "/chargers", "/status", "/history", "/stats", "/metrics")
+REQUEST_SECONDS = metrics.histogram("defa_request_seconds", "Time to handle a request", ("path", ))
+
+def request_done(path, start):
+    REQUEST_SECONDS.labels(path if path in ENDPOINTS else "/").since(start)
+
+def metrics_response():
+    body = metrics.render()
+    return 200, [("Content-type", metrics.CONTENT_TYPE), ("Content-Length", str(len(body)))], body
+
+# Responses at least this large are gzipped if the client accepts it.
+GZIP_MIN_SIZE = 1400
+
+# Builds the JSON body and ETag (or None) for a GET of the given URL, except
+# /stream. Raises ValueError for a bad query.
+def render(url):
+    if url.path == "/chargers":
+        # latest readings of every charger seen
+        latest = dict(decoder.latest)
+        return json.dumps({serial: readings_dict(r) for serial, r in latest.items()}).encode(), None
+    if url.path == "/status":
+        return json.dumps(decoder.stats()).encode(), None
+    if url.path in ("/history", "/stats"):
+        query = parse_qs(url.query)
+        try:
+            window = float(query.get("window", [3600])[0])
+            if not math.isfinite(window) or window <= 0:
+                raise ValueError()
+        except ValueError:
+            raise ValueError("Expected window=<seconds>[&serial=<serial>]")
+        windows = shared_history.windows(window, query.get("serial", [None])[0])
+        if url.path == "/history":
+            return render_history(windows), None
+        return render_stats(windows), None
+
+    # latest reading, of the given charger or whichever sent the last packet
+    serial = parse_qs(url.query).get("serial", [None])[0]
+    if serial is None:
+        data = shared_readings.get_data()
+    elif serial in decoder.latest:
+        data = readings_dict(decoder.latest[serial])
+    else:
+        raise ValueError("Unknown charger %s" % (serial, ))
+    etag = '"%s/%s"' % (data["serial"], data["timestamp_utc"])
+    return json.dumps(data).encode(), etag
+
+# GET /history?window=<seconds>&serial=<serial>
+# Readings per charger as columns, 'window' defaults to an hour.
+def render_history(windows):
+    result = {}
+    for serial, (times, phases) in windows.items():
+        result[serial] = {"time": times.tolist()}
+        for name, values in zip(PHASES, phases):
+            result[serial][name] = values.tolist()
+    return json.dumps(result).encode()
+
+# GET /stats?window=<seconds>&serial=<serial>
+# min/max/mean/percentiles per charger and phase, 'window' defaults to an hour.
+def render_stats(windows):
+    result = {}
+    for serial, (times, phases) in windows.items():
+        result[serial] = {"count": len(times)}
+        for name, values in zip(PHASES, phases):
+            result[serial][name] = stats(values)
+    return json.dumps(result).encode()
+
+# Returns (status, headers, body) for a JSON body given the request's
+# If-None-Match and Accept-Encoding headers.
+def json_response(body, etag, if_none_match, accept_encoding):
+    if etag is not None and etag in if_none_match:
+        return 304, [("ETag", etag)], b""
+
+    headers = [("Content-type", "application/json")]
+    if len(body) >= GZIP_MIN_SIZE and "gzip" in accept_encoding:
+        body = zlib.compress(body, wbits=31)
+        headers.append(("Content-Encoding", "gzip"))
+    headers.append(("Content-Length", str(len(body))))
+    if etag is not None:
+        headers.append(("ETag", etag))
+    return 200, headers, body
+
+STREAM_HEADERS = [
+    ("Content-type", "text/event-stream"),
+    ("Cache-Control", "no-cache"),
+    ("Connection", "close")
+]
+
 class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 gives us keep-alive; idle connections are closed after timeout seconds.
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    # Headers and body are written separately, don't let Nagle delay the body
+    # until the client's delayed ACK on kept-alive connections.
+    disable_nagle_algorithm = True
+
     def do_GET(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path == "/stream":
+            self.send_stream(parse_qs(url.query).get("serial", [None])[0])
+            return
+        if url.path == "/metrics":
+            status, headers, body = metrics_response()
+        else:
+            try:
+                body, etag = render(url)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            status, headers, body = json_response(body, etag,
+                self.headers.get("If-None-Match", ""), self.headers.get("Accept-Encoding", ""))
+
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        request_done(url.path, start)
+
+    # GET /stream?serial=<serial>
+    # Server-sent events with every reading as it arrives.
+    def send_stream(self, serial):
         self.send_response(200)
-        self.send_header("Content-type", "application/json")
+        for name, value in STREAM_HEADERS:
+            self.send_header(name, value)
         self.end_headers()
-        data = shared_readings.get_data()
-        self.wfile.write(json.dumps(data).encode())
+        self.close_connection = True
+
+        subscriber = broadcaster.subscribe(Subscriber(serial))
+        try:
+            while True:
+                events = subscriber.get(STREAM_KEEPALIVE)
+                self.wfile.write(b"".join(events) if events else b": keepalive\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            broadcaster.unsubscribe(subscriber)
 
-def run_server():
-    server_address = ("0.0.0.0", 8000)
-    httpd = http.server.HTTPServer(server_address, SimpleHTTPRequestHandler)
-    print("Serving on port 8000...")
+def run_server(port=HTTP_PORT):
+    server_address = ("0.0.0.0", port)
+    httpd = http.server.ThreadingHTTPServer(server_address, SimpleHTTPRequestHandler)
+    print("Serving on port %d..." % (port, ))
     httpd.serve_forever()
 
 
@@ -71,53 +398,160 @@ def print_unknown(data, size, offs = 0):
         print("- offset %d: %d (%s)" % (i, num, hex(num)))
         i += size
 
-def read_data():
+def read_data(sock):
     # Receive the data, note that this is a blocking call
     while True:
-        data, _ = sock.recvfrom(10240)
-
-        # L437704C1A4
-        first = data[0:2].decode("ascii")
-        serial = data[2:11].decode("ascii")
-        millis = int.from_bytes(data[11:19], "little")
-        timestamp = Epoch + timedelta(milliseconds = millis)
-        unknown = data[19:30]
-        version = data[30:38].decode("ascii")
-
-        phase_1 = int.from_bytes(unknown[1:3], "little") / 1000.0
-        phase_2 = int.from_bytes(unknown[4:6], "little") / 1000.0
-        phase_3 = int.from_bytes(unknown[7:9], "little") / 1000.0
-
-        latest_readings = {
-            "timestamp_utc": str(timestamp),
-            "serial": serial,
-            "phase1_amps": phase_1,
-            "phase2_amps": phase_2,
-            "phase3_amps": phase_3
-        }
-        shared_readings.update_data(latest_readings)
-
-        #print("---")
-        #print("first two: %s" % (first, ))
-        #print("serial   : %s" % (serial, ))
-        #print("time UTC : %s" % (timestamp, ))
-        #print("version  : %s" % (version, ))
-        #print("phase 1  : %.2f" % (phase_1, ))
-        #print("phase 2  : %.2f" % (phase_2, ))
-        #print("phase 3  : %.2f" % (phase_3, ))
-        #print("-")
-        #print_unknown(unknown, 1)
-        #print_unknown(unknown, 2)
-        #print_unknown(unknown, 4)
-        #print_unknown(unknown, 1, 1)
-        #print_unknown(unknown, 2, 1)
-        #print_unknown(unknown, 4, 1)
+        reading = decoder.receive(sock)
+        if reading is not None:
+            handle_reading(reading)
+
+def handle_packet(data):
+    reading = decoder.decode(data)
+    if reading is not None:
+        handle_reading(reading)
+
+def handle_reading(reading):
+    latest_readings = readings_dict(reading)
+    shared_readings.update_data(latest_readings)
+    shared_history.add(reading.serial, time.time(), (reading.phase1_amps, reading.phase2_amps, reading.phase3_amps))
+    broadcaster.publish(latest_readings)
+
+    #print("---")
+    #print("first two: %s" % (reading.first, ))
+    #print("serial   : %s" % (reading.serial, ))
+    #print("time UTC : %s" % (timestamp_utc(reading.millis), ))
+    #print("version  : %s" % (reading.version, ))
+    #print("phase 1  : %.2f" % (reading.phase1_amps, ))
+    #print("phase 2  : %.2f" % (reading.phase2_amps, ))
+    #print("phase 3  : %.2f" % (reading.phase3_amps, ))
+    #print("-")
+    #unknown = decoder.buffer[19:30]
+    #print_unknown(unknown, 1)
+    #print_unknown(unknown, 2)
+    #print_unknown(unknown, 4)
+    #print_unknown(unknown, 1, 1)
+    #print_unknown(unknown, 2, 1)
+    #print_unknown(unknown, 4, 1)
+
+# Asyncio mode: the multicast socket and the HTTP server share one event loop,
+# so readings are handed over without threads or locks.
+
+class MulticastProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        handle_packet(data)
+
+async def write_response(writer, status, headers, body=b""):
+    lines = ["HTTP/1.1 %d %s" % (status, http.server.BaseHTTPRequestHandler.responses[status][0])]
+    lines += ["%s: %s" % (name, value) for name, value in headers]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+async def stream_async(writer, serial):
+    await write_response(writer, 200, STREAM_HEADERS)
+    subscriber = broadcaster.subscribe(AsyncSubscriber(serial))
+    try:
+        while True:
+            events = await subscriber.get(STREAM_KEEPALIVE)
+            writer.write(b"".join(events) if events else b": keepalive\n\n")
+            await writer.drain()
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+# Minimal HTTP/1.1 GET handling with keep-alive, serving the same endpoints
+# as SimpleHTTPRequestHandler.
+async def handle_http(reader, writer):
+    try:
+        while True:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SimpleHTTPRequestHandler.timeout)
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+            start = time.perf_counter()
+            url = urlsplit(target)
+            if method != "GET":
+                await write_response(writer, 405, [("Content-Length", "0")])
+            elif url.path == "/stream":
+                await stream_async(writer, parse_qs(url.query).get("serial", [None])[0])
+                break
+            else:
+                if url.path == "/metrics":
+                    status, resp_headers, body = metrics_response()
+                else:
+                    try:
+                        body, etag = render(url)
+                        status, resp_headers, body = json_response(body, etag,
+                            headers.get("if-none-match", ""), headers.get("accept-encoding", ""))
+                    except ValueError as e:
+                        status, resp_headers, body = 400, [("Content-type", "text/plain")], str(e).encode()
+                        resp_headers.append(("Content-Length", str(len(body))))
+                if not keep_alive:
+                    resp_headers.append(("Connection", "close"))
+                await write_response(writer, status, resp_headers, body)
+                request_done(url.path, start)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def run_async(sock, port=HTTP_PORT):
+    # everything runs on this loop, so the shared state needs no locks
+    shared_readings.lock = shared_history.lock = broadcaster.lock = nullcontext()
+
+    loop = asyncio.get_running_loop()
+    metrics.watch_loop_lag(loop, name="defa_event_loop_lag_seconds")
+    await loop.create_datagram_endpoint(MulticastProtocol, sock=sock)
+    server = await asyncio.start_server(handle_http, "0.0.0.0", port)
+    print("Serving on port %d (asyncio)..." % (port, ))
+    async with server:
+        await server.serve_forever()
+
+def usage():
+    print(sys.argv[0] + " [-h][-a] [-g multicast groups] [-i interfaces] [-p HTTP port]")
+    print("\t-a  : run the multicast reader and HTTP server on one asyncio event loop")
+    print("\t-g  : comma-separated multicast groups to join (default %s)" % (MCAST_GRP, ))
+    print("\t-i  : comma-separated addresses of interfaces to join the groups on (default any)")
+    print("\t-p  : HTTP port (default %d)" % (HTTP_PORT, ))
+    print("\t-h  : show this help")
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "hag:i:p:")
+    use_asyncio = False
+    groups = [MCAST_GRP]
+    interfaces = ["0.0.0.0"]
+    port = HTTP_PORT
+    for o, a in opts:
+        if o == "-a":
+            use_asyncio = True
+        elif o == "-g":
+            groups = a.split(",")
+        elif o == "-i":
+            interfaces = a.split(",")
+        elif o == "-p":
+            port = int(a)
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    sock = open_socket(groups, interfaces)
+    if use_asyncio:
+        asyncio.run(run_async(sock, port))
+        return
 
-if __name__ == "__main__":
     # Create a thread to run the server
-    server_thread = threading.Thread(target=run_server)
+    server_thread = threading.Thread(target=run_server, args=(port, ))
     server_thread.daemon = True
     server_thread.start()
 
-    read_data()
+    read_data(sock)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# Layout of a DEFA Power load balancing multicast packet, e.g. from serial L437704C1A4:
+#  0: first two characters ("L4")
+#  2: serial (9 ASCII characters)
+# 11: time, milliseconds since the epoch (UTC)
+# 19: 11 bytes, mostly unknown, with the three phase currents in mA at 20, 23 and 26
+# 30: firmware version (8 ASCII characters)
+PACKET = struct.Struct("<2s9sQxHxHxH2x8s")
+
+# Large enough for any packet we expect
+BUFFER_SIZE = 10240
+
+Epoch = datetime(1970, 1, 1)
+# Times past this don't fit in a datetime, the packet is garbage
+MAX_MILLIS = (datetime.max - Epoch) // timedelta(milliseconds=1)
+
+Reading = namedtuple("Reading", ["first", "serial", "millis", "phase1_amps", "phase2_amps", "phase3_amps", "version"])
+
+def timestamp_utc(millis):
+    return Epoch + timedelta(milliseconds = millis)
+
+# Decodes packets into Readings, keeping the latest reading per charger serial
+# and counters for received and malformed packets and decode time.
+class Decoder:
+    def __init__(self):
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.latest = {}
+        self.packets = 0
+        self.malformed = 0
+        self.decode_ns = 0
+        self.rate = 0.0
+        self.rate_time = time.monotonic()
+        self.rate_packets = 0
+        # the same few strings arrive over and over, decode them once
+        self.strings = {}
+
+    def ascii(self, raw):
+        s = self.strings.get(raw)
+        if s is None:
+            if len(self.strings) > 1000:
+                self.strings.clear() # junk, don't grow forever
+            s = self.strings[raw] = raw.decode("ascii")
+        return s
+
+    # Receives one packet into the reused buffer and decodes it. Returns the
+    # Reading, or None if the packet was malformed.
+    def receive(self, sock):
+        n, _ = sock.recvfrom_into(self.buffer)
+        return self.decode(self.buffer, n)
+
+    def decode(self, data, n=None):
+        start = time.perf_counter_ns()
+        self.packets += 1
+        if (len(data) if n is None else n) < PACKET.size:
+            self.malformed += 1
+            return None
+        first, serial, millis, p1, p2, p3, version = PACKET.unpack_from(data)
+        if millis > MAX_MILLIS:
+            self.malformed += 1
+            return None
+        try:
+            reading = Reading(self.ascii(first), self.ascii(serial), millis,
+                              p1 / 1000.0, p2 / 1000.0, p3 / 1000.0, self.ascii(version))
+        except UnicodeDecodeError:
+            self.malformed += 1
+            return None
+        self.latest[reading.serial] = reading
+        self.decode_ns += time.perf_counter_ns() - start
+        return reading
+
+    # Packets per second, averaged over at least a second.
+    def packet_rate(self):
+        now = time.monotonic()
+        if now - self.rate_time >= 1.0:
+            self.rate = (self.packets - self.rate_packets) / (now - self.rate_time)
+            self.rate_time = now
+            self.rate_packets = self.packets
+        return self.rate
+
+    def stats(self):
+        decoded = self.packets - self.malformed
+        return {
+            "packets": self.packets,
+            "malformed": self.malformed,
+            "packets_per_second": self.packet_rate(),
+            "mean_decode_us": self.decode_ns / decoded / 1000.0 if decoded else 0.0,
+            "chargers": sorted(self.latest)
+        }
@@ -0,0 +1,135 @@
+import http.client
+import json
+import os
+import sys
+
+# Home Assistant connection settings, a file with shell variable assignments:
+#   HASS_API_TOKEN=...
+#   HASS_HOST=...
+#   HASS_PORT=8123
+CONFIG_PATH = "~/.hass_api"
+# The last applied state of each entity, so that only changes are sent
+STATE_PATH = "~/.cache/hass_state.json"
+
+def read_config(path=CONFIG_PATH):
+    config = {}
+    with open(os.path.expanduser(path), "r") as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith("export "):
+                line = line[len("export "):]
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            name, value = line.split("=", 1)
+            config[name.strip()] = value.strip().strip("\"'")
+    return config
+
+# Client for the Home Assistant REST API over one keep-alive connection.
+class Client:
+    def __init__(self, host, port, token, state_path=STATE_PATH):
+        self.host = host
+        self.port = int(port)
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        }
+        self.connection = None
+        self.requests = 0
+        self.state_path = None if state_path is None else os.path.expanduser(state_path)
+        self.state = None
+
+    @staticmethod
+    def from_config(path=CONFIG_PATH, state_path=STATE_PATH):
+        config = read_config(path)
+        return Client(config["HASS_HOST"], config["HASS_PORT"], config["HASS_API_TOKEN"], state_path)
+
+    def request(self, method, path, body):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        self.connection.request(method, path, body=body, headers=self.headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        self.requests += 1
+        if response.status >= 400:
+            raise Exception(f"{path} returned {response.status}: {data.decode(errors='replace')}")
+        return data
+
+    # Calls a service for one or more entities in a single request, e.g.
+    # call_service("light", "turn_off", ["light.a", "light.b"]).
+    def call_service(self, domain, service, entity_ids):
+        path = f"/api/services/{domain}/{service}"
+        body = json.dumps({ "entity_id": entity_ids }).encode()
+        try:
+            return self.request("POST", path, body)
+        except (http.client.HTTPException, OSError):
+            # Home Assistant may have closed the idle connection, retry once on a new one
+            self.close()
+            return self.request("POST", path, body)
+
+    def load_state(self):
+        if self.state is None:
+            self.state = {}
+            if self.state_path is not None:
+                try:
+                    with open(self.state_path) as f:
+                        self.state = json.load(f)
+                except FileNotFoundError:
+                    pass
+                except ValueError as e:
+                    print(f"Ignoring state file {self.state_path}: {e}", file=sys.stderr)
+        return self.state
+
+    def save_state(self):
+        if self.state_path is None:
+            return
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    # Applies the desired states, { key: (domain, service, entity ID) } where
+    # key identifies what is controlled, e.g. a light turned off by
+    # ("light", "turn_off", "light.x") or given a color by a scene. Only keys
+    # whose state changed since the last apply are sent, with one request per
+    # service. With force, everything is sent. Returns the changed keys.
+    def apply(self, desired, force=False):
+        state = self.load_state()
+        changed = [key for key, call in desired.items() if force or state.get(key) != list(call)]
+        batches = {}
+        for key in changed:
+            domain, service, entity_id = desired[key]
+            batches.setdefault((domain, service), []).append(entity_id)
+        for (domain, service), entity_ids in batches.items():
+            self.call_service(domain, service, entity_ids)
+        if changed:
+            for key in changed:
+                state[key] = list(desired[key])
+            self.save_state()
+        return changed
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def usage():
+    print(f"{sys.argv[0]} <scene|light_off> <ID>...")
+    print(f"\tscene      : activate scene.<ID> for each ID")
+    print(f"\tlight_off  : turn off light.<ID> for each ID")
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("scene", "light_off"):
+        usage()
+        sys.exit(2)
+    client = Client.from_config(state_path=None)
+    try:
+        if sys.argv[1] == "scene":
+            client.call_service("scene", "turn_on", ["scene." + id for id in sys.argv[2:]])
+        else:
+            client.call_service("light", "turn_off", ["light." + id for id in sys.argv[2:]])
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
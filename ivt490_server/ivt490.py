@@ -1,19 +1,61 @@
 import os
-from datetime import datetime
+import mmap
+from datetime import datetime, timedelta
 import json
+import struct
+import time
+import ivt490bin
+import ivt490archive
+
+# Power model: electric heater at full effect, and the fixed draw of the
+# fan, compressor and circulation pump when they run.
+ELEC_KW = 9.0
+FAN_KW = 0.165
+COMP_KW = 0.5
+PUMP_KW = 0.1
+
+# ivt490d samples about once a minute. A feed reading older than this
+# means ivt490d stopped or runs without the feed, use the day files.
+FEED_MAX_AGE = 180
+
+# Record indices decoded by recordToDict, records with junk in any of these are skipped.
+USED_FIELDS = (2, 3, 4, 5, 6, 8, 14, 17, 18, 19, 23, 34, 36, 37)
 
 def readLastLine(filepath):
     with open(filepath, "rb") as f:
-        try:  # catch OSError in case of a one line file 
-            f.seek(-2, os.SEEK_END)
-            while f.read(1) != b'\n':
-                f.seek(-2, os.SEEK_CUR)
-        except OSError:
-            f.seek(0)
-        return f.readline().decode()
+        # read backwards in blocks until we have a complete last line
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        tail = b""
+        while pos > 0:
+            size = min(1024, pos)
+            pos -= size
+            f.seek(pos)
+            tail = f.read(size) + tail
+            if tail.find(b"\n", 0, len(tail) - 1) >= 0:
+                break
+        return tail[tail.rfind(b"\n", 0, len(tail) - 1) + 1:].decode()
 
-def lineToJson(csvLine):
-    parts = csvLine.split(";")
+# Reads the last complete record of a binary day file, skipping back over
+# records with junk values like readBinaryRange does.
+def readLastRecord(filepath):
+    with open(filepath, "rb") as f:
+        rec = ivt490bin.decodeHeader(f.read(ivt490bin.header.size))
+        end = f.seek(0, os.SEEK_END)
+        count = (end - ivt490bin.header.size) // rec.size
+        for i in range(count - 1, -1, -1):
+            f.seek(ivt490bin.header.size + i * rec.size)
+            r = rec.unpack(f.read(rec.size))
+            if not any(r[j] == ivt490bin.MISSING for j in USED_FIELDS):
+                return r
+        raise ValueError("No complete records in " + filepath)
+
+def lineToDict(csvLine):
+    return recordToDict(csvLine.split(";"))
+
+# Decodes a record, either the parts of a CSV line or a binary record. Both
+# are indexed the same way, with the time first.
+def recordToDict(parts):
     time = float(parts[0])
 
     # uptime is not reliable:
@@ -39,16 +81,11 @@ def lineToJson(csvLine):
     elec_rad = int(parts[36]) / 10.0
     elec_vv = int(parts[37]) / 10.0
 
-    elec_kw = 9.0
-    est_kw = 9.0 * elec_sum / 100.0
-
-    fan_kw = 0.165
-    comp_kw = 0.5
-    pump_kw = 0.1
+    est_kw = ELEC_KW * elec_sum / 100.0
 
-    current_fan_kw = fan_kw if b9 else 0.0
-    current_comp_kw = comp_kw if b5 else 0.0
-    current_pump_kw = pump_kw if b8 else 0.0
+    current_fan_kw = FAN_KW if b9 else 0.0
+    current_comp_kw = COMP_KW if b5 else 0.0
+    current_pump_kw = PUMP_KW if b8 else 0.0
 
     total_kw = est_kw + current_fan_kw + current_comp_kw + current_pump_kw
 
@@ -89,12 +126,177 @@ def lineToJson(csvLine):
         }
     }
 
-    return json.dumps(data, indent=4)
+    return data
+
+def lineToJson(csvLine):
+    return json.dumps(lineToDict(csvLine), indent=4)
+
+def dayFilePath(basepath, day, ext=".dat"):
+    return basepath + "/" + day.strftime("%Y%m%d") + ext
+
+# The file for a day, preferring the binary format if ivt490d writes it.
+# Old days may only be available as compressed archives.
+def dayFile(basepath, day):
+    for ext in (".bin", ".dat", ivt490archive.EXT):
+        filepath = dayFilePath(basepath, day, ext)
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+# Time (first column) of the line starting at the given offset.
+def timeAt(mm, start, end):
+    sep = mm.find(b";", start, end)
+    return float(mm[start:sep if sep >= 0 else end])
+
+# Binary search over byte offsets in a memory-mapped day file. The first
+# column is a monotonic epoch, so we can find the offset of the first line
+# with a time >= t without scanning the file.
+def findTimeOffset(mm, t, lo=0):
+    hi = len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = mm.rfind(b"\n", 0, mid) + 1
+        end = mm.find(b"\n", start)
+        if end < 0:
+            end = len(mm)
+        if timeAt(mm, start, end) < t:
+            lo = end + 1
+        else:
+            hi = start
+    return lo
+
+# Yields the raw lines of a day file with from_time <= time < to_time. If step
+# is given, lines less than step seconds after the previous one are skipped.
+def readFileRange(filepath, from_time, to_time, step=0):
+    try:
+        f = open(filepath, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = findTimeOffset(mm, from_time)
+            size = len(mm)
+            while pos < size:
+                end = mm.find(b"\n", pos)
+                if end < 0:
+                    break # partial line still being written by the daemon
+                time = timeAt(mm, pos, end)
+                if time >= to_time:
+                    break
+                yield mm[pos:end].decode()
+                pos = end + 1
+                if step > 0:
+                    pos = findTimeOffset(mm, time + step, pos)
+
+timeStruct = struct.Struct("<d")
+
+# Index of the first record with a time >= t in a memory-mapped binary file.
+def findRecordIndex(mm, rec, count, t, lo=0):
+    hi = count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if timeStruct.unpack_from(mm, ivt490bin.header.size + mid * rec.size)[0] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+# Like readFileRange, but for binary day files. Records are unpacked directly
+# from the memory map and yielded as tuples.
+def readBinaryRange(filepath, from_time, to_time, step=0):
+    try:
+        f = open(filepath, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size < ivt490bin.header.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            rec = ivt490bin.decodeHeader(mm)
+            count = (len(mm) - ivt490bin.header.size) // rec.size
+            i = findRecordIndex(mm, rec, count, from_time)
+            while i < count:
+                r = rec.unpack_from(mm, ivt490bin.header.size + i * rec.size)
+                if r[0] >= to_time:
+                    break
+                i += 1
+                if any(r[j] == ivt490bin.MISSING for j in USED_FIELDS):
+                    continue # junk values
+                yield r
+                if step > 0:
+                    i = findRecordIndex(mm, rec, count, r[0] + step, i)
+
+def readDayRange(basepath, day, from_time, to_time, step=0):
+    filepath = dayFile(basepath, day)
+    if filepath is None:
+        return iter(())
+    if filepath.endswith(".bin"):
+        return readBinaryRange(filepath, from_time, to_time, step)
+    if filepath.endswith(ivt490archive.EXT):
+        return (csvLine.split(";") for csvLine in ivt490archive.readArchiveRange(filepath, from_time, to_time, step))
+    return (csvLine.split(";") for csvLine in readFileRange(filepath, from_time, to_time, step))
+
+# Yields decoded records between from_time and to_time (epoch seconds),
+# reading only the relevant part of each day file. If step is given, at most
+# one record per step seconds is returned.
+def readHistory(basepath, from_time, to_time, step=0):
+    day = datetime.fromtimestamp(from_time).date()
+    last_day = datetime.fromtimestamp(to_time).date()
+    next_time = from_time
+    while day <= last_day:
+        for parts in readDayRange(basepath, day, next_time, to_time, step):
+            try:
+                data = recordToDict(parts)
+            except (IndexError, ValueError):
+                continue # junk line
+            if step > 0:
+                next_time = data["time"] + step
+            yield data
+        day += timedelta(days=1)
+
+# Cache of the latest record per base path: a key telling where it was read
+# from ((filepath, size, mtime) or the feed sequence number), the decoded
+# record and its pre-encoded JSON.
+latestCache = {}
+
+def cachedLatest(basepath, key, decode):
+    cached = latestCache.get(basepath)
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+    data = decode()
+    jsonBytes = json.dumps(data, indent=4).encode()
+    latestCache[basepath] = (key, data, jsonBytes)
+    return data, jsonBytes
+
+# If a FeedReader is given, the latest reading is taken from the live feed
+# written by ivt490d when available and recent (FEED_MAX_AGE).
+def latestRecord(basepath, feed=None):
+    if feed is not None:
+        latest = feed.latest()
+        if (latest is not None and time.time() - latest[1][0] <= FEED_MAX_AGE
+                and not any(latest[1][j] == ivt490bin.MISSING for j in USED_FIELDS)):
+            key = (feed.path, feed.ino, latest[0])
+            return cachedLatest(basepath, key, lambda: recordToDict(latest[1]))
+
+    now = datetime.now()
+    filepath = dayFile(basepath, now)
+    if filepath is None:
+        # just after midnight, before the first reading of the new day
+        filepath = dayFile(basepath, now - timedelta(days=1))
+        if filepath is None:
+            raise FileNotFoundError("No day file in " + basepath)
+    st = os.stat(filepath)
+    key = (filepath, st.st_size, st.st_mtime_ns)
+    if filepath.endswith(".bin"):
+        return cachedLatest(basepath, key, lambda: recordToDict(readLastRecord(filepath)))
+    if filepath.endswith(ivt490archive.EXT):
+        return cachedLatest(basepath, key, lambda: lineToDict(ivt490archive.readLastArchivedLine(filepath)))
+    return cachedLatest(basepath, key, lambda: lineToDict(readLastLine(filepath)))
 
 def latestLineAsJson(basepath):
-    filepath = basepath + "/" + datetime.now().strftime("%Y%m%d") + ".dat"
-    csvLine = readLastLine(filepath)
-    return lineToJson(csvLine)
+    return latestRecord(basepath)[1].decode()
 
 if __name__ == "__main__":
     print(latestLineAsJson("/media/passport/dump/ivt490"))
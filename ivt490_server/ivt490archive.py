@@ -0,0 +1,138 @@
+
+# Seekable compressed archives of closed IVT490 day files.
+#
+# An archive, YYYYMMDD.datz, holds the CSV lines of a day in zlib compressed
+# blocks. It starts with the same kind of header as ivt490bin (the reserved
+# word holds the block count), followed by an index with the time of the
+# first line, offset and length of each block, so readers only decompress
+# the blocks covering the range they need.
+#
+# Usage:
+#   python ivt490archive.py <base path> [days to keep uncompressed, default 3]
+# archives day files older than that and removes the originals.
+
+import os
+import struct
+import sys
+import zlib
+from datetime import datetime, timedelta
+import ivt490bin
+
+MAGIC = b"IVT490Z\x01"
+EXT = ".datz"
+BLOCK_LINES = 512
+KEEP_DAYS = 3
+
+index = struct.Struct("<dQI")
+
+# Compresses CSV lines (without line endings) into archive bytes.
+def encodeArchive(lines):
+    blocks = []
+    for i in range(0, len(lines), BLOCK_LINES):
+        chunk = lines[i:i + BLOCK_LINES]
+        first = float(chunk[0].split(";", 1)[0])
+        blocks.append((first, zlib.compress(("\n".join(chunk) + "\n").encode(), 9)))
+    offset = ivt490bin.header.size + len(blocks) * index.size
+    out = [ivt490bin.header.pack(MAGIC, len(blocks), 0)]
+    for first, data in blocks:
+        out.append(index.pack(first, offset, len(data)))
+        offset += len(data)
+    out += [data for _, data in blocks]
+    return b"".join(out)
+
+# Returns the block index of an open archive: a list of (first time, offset, length).
+def readIndex(f):
+    magic, nblocks, _ = ivt490bin.header.unpack(f.read(ivt490bin.header.size))
+    if magic != MAGIC:
+        raise ValueError("Not an IVT490 archive")
+    buf = f.read(nblocks * index.size)
+    return list(index.iter_unpack(buf))
+
+def readBlock(f, entry):
+    f.seek(entry[1])
+    return zlib.decompress(f.read(entry[2])).decode().splitlines()
+
+# Yields the CSV lines of an archive with from_time <= time < to_time,
+# decompressing only the blocks that can contain them.
+def readArchiveRange(filepath, from_time, to_time, step=0):
+    try:
+        f = open(filepath, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        entries = readIndex(f)
+        next_time = from_time
+        for i, entry in enumerate(entries):
+            if entry[0] >= to_time:
+                break
+            if i + 1 < len(entries) and entries[i + 1][0] <= next_time:
+                continue # all lines in this block are too early
+            for line in readBlock(f, entry):
+                time = float(line.split(";", 1)[0])
+                if time < next_time:
+                    continue
+                if time >= to_time:
+                    return
+                yield line
+                if step > 0:
+                    next_time = time + step
+
+def readLastArchivedLine(filepath):
+    with open(filepath, "rb") as f:
+        entries = readIndex(f)
+        if not entries:
+            raise ValueError("No records in " + filepath)
+        return readBlock(f, entries[-1])[-1]
+
+def readAllLines(filepath):
+    with open(filepath, "rb") as f:
+        return [line for entry in readIndex(f) for line in readBlock(f, entry)]
+
+def readDayLines(filepath):
+    if filepath.endswith(".bin"):
+        with open(filepath, "rb") as f:
+            buf = f.read()
+        rec = ivt490bin.decodeHeader(buf)
+        end = ivt490bin.header.size + (len(buf) - ivt490bin.header.size) // rec.size * rec.size
+        return [ivt490bin.decodeToLine(r) for r in rec.iter_unpack(buf[ivt490bin.header.size:end])]
+    with open(filepath, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+# Archives one day, preferring the CSV file since it keeps the raw values.
+# The original files are removed once the archive has been written and read back.
+def archiveDay(basepath, day):
+    sources = [basepath + "/" + day + ext for ext in (".dat", ".bin")]
+    sources = [p for p in sources if os.path.exists(p)]
+    if not sources:
+        return False
+    lines = readDayLines(sources[0])
+    target = basepath + "/" + day + EXT
+    tmp = target + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(encodeArchive(lines))
+        f.flush()
+        os.fsync(f.fileno())
+    if readAllLines(tmp) != lines:
+        os.remove(tmp)
+        raise ValueError("Archive of %s did not read back correctly" % (day, ))
+    os.rename(tmp, target)
+    for p in sources:
+        os.remove(p)
+    return True
+
+def archiveOld(basepath, keep_days=KEEP_DAYS):
+    last = (datetime.now() - timedelta(days=keep_days)).strftime("%Y%m%d")
+    days = set()
+    for name in os.listdir(basepath):
+        day, ext = os.path.splitext(name)
+        if ext in (".dat", ".bin") and len(day) == 8 and day.isdigit() and day < last:
+            days.add(day)
+    for day in sorted(days):
+        archiveDay(basepath, day)
+        print(f"Archived {day}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"{sys.argv[0]} <base path> [days to keep uncompressed, default {KEEP_DAYS}]")
+        sys.exit(2)
+    archiveOld(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else KEEP_DAYS)
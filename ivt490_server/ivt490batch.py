@@ -0,0 +1,191 @@
+
+# Batch decoding of whole IVT490 day files into NumPy columns, and daily
+# energy reports computed over them.
+#
+# Note:
+# pip install numpy
+#
+# Usage:
+#   python ivt490batch.py <base path> <first day YYYYMMDD> [last day YYYYMMDD]
+
+import os
+import sys
+import warnings
+from datetime import datetime, timedelta
+import numpy as np
+import ivt490
+import ivt490bin
+import ivt490archive
+
+# Column name -> index in a record (same indexing as ivt490.recordToDict)
+TEMPERATURES = {
+    "gt1": 2,
+    "gt2": 3,
+    "gt3_1": 4,
+    "gt3_2": 5,
+    "gt3_3": 6,
+    "gt6": 8,
+    "estimated": 23,
+}
+FLAGS = {
+    "b5": 14,
+    "b8": 17,
+    "b9": 18,
+    "b10": 19,
+}
+PERCENTAGES = {
+    "sum_pct": 34,
+    "rad_pct": 36,
+    "vv_pct": 37,
+}
+
+USED_COLUMNS = [i - 1 for i in ivt490.USED_FIELDS]
+
+# Samples further apart than this are treated as a gap in the data when integrating.
+MAX_GAP = 300.0
+
+def binaryDtype(nfields=ivt490bin.NFIELDS):
+    return np.dtype([("time", "<f8"), ("fields", "<i2", (nfields, ))])
+
+def emptyRaw():
+    return np.empty(0, "<f8"), np.empty((0, ivt490bin.NFIELDS), "<i2")
+
+# Returns (time, fields) for a binary day file, fields[:, i - 1] being record index i.
+def loadBinary(filepath):
+    with open(filepath, "rb") as f:
+        rec = ivt490bin.decodeHeader(f.read(ivt490bin.header.size))
+    count = (os.path.getsize(filepath) - ivt490bin.header.size) // rec.size
+    if count == 0:
+        return emptyRaw()
+    dtype = binaryDtype(rec.size // 2 - 4)
+    arr = np.memmap(filepath, dtype, mode="r", offset=ivt490bin.header.size, shape=(count, ))
+    return arr["time"], arr["fields"]
+
+# Same as loadBinary, but for a CSV day file (or a list of CSV lines). Uptime
+# is not reliable (see ivt490.recordToDict) so it is never parsed. Files with
+# junk in other columns fall back to parsing line by line, dropping the bad lines.
+def loadCsv(source):
+    if isinstance(source, str) and os.path.getsize(source) == 0:
+        return emptyRaw()
+    usecols = [0] + list(range(2, ivt490bin.NFIELDS + 1))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            data = np.loadtxt(source, delimiter=";", usecols=usecols, ndmin=2)
+    except ValueError:
+        if not isinstance(source, str):
+            return loadCsvSlow(source)
+        with open(source, "r") as f:
+            return loadCsvSlow(f)
+    fields = np.empty((len(data), ivt490bin.NFIELDS), "<i2")
+    fields[:, 0] = ivt490bin.MISSING
+    fields[:, 1:] = data[:, 1:]
+    return data[:, 0], fields
+
+def loadCsvSlow(lines):
+    buf = bytearray()
+    for line in lines:
+        try:
+            buf += ivt490bin.encodeLine(line.strip())
+        except ValueError:
+            pass
+    arr = np.frombuffer(bytes(buf), binaryDtype())
+    return arr["time"], arr["fields"]
+
+def loadFile(filepath):
+    if filepath.endswith(".bin"):
+        return loadBinary(filepath)
+    if filepath.endswith(ivt490archive.EXT):
+        lines = ivt490archive.readAllLines(filepath)
+        return loadCsv(lines) if lines else emptyRaw()
+    return loadCsv(filepath)
+
+# Loads the day files from first_day to last_day (dates, inclusive) into one
+# dict of columns. The "day" column holds the index of each sample's day.
+def loadDays(basepath, first_day, last_day):
+    times = []
+    fieldss = []
+    days = []
+    day = first_day
+    while day <= last_day:
+        filepath = ivt490.dayFile(basepath, day)
+        if filepath is not None:
+            time, fields = loadFile(filepath)
+            # drop records with junk in the columns we decode
+            ok = (fields[:, USED_COLUMNS] != ivt490bin.MISSING).all(axis=1)
+            times.append(time[ok])
+            fieldss.append(fields[ok])
+            days.append(np.full(ok.sum(), (day - first_day).days, np.int32))
+        day += timedelta(days=1)
+    if not times:
+        times, fieldss = [emptyRaw()[0]], [emptyRaw()[1]]
+        days = [np.empty(0, np.int32)]
+    return decodeColumns(np.concatenate(times), np.concatenate(fieldss), np.concatenate(days))
+
+# Applies the ivt490.recordToDict decoding and power model to whole columns.
+def decodeColumns(time, fields, day=None):
+    cols = {"time": time}
+    if day is not None:
+        cols["day"] = day
+    for name, i in TEMPERATURES.items():
+        cols[name] = fields[:, i - 1] / 10.0
+    for name, i in FLAGS.items():
+        cols[name] = fields[:, i - 1] != 0
+    for name, i in PERCENTAGES.items():
+        cols[name] = fields[:, i - 1] / 10.0
+
+    cols["est_kw"] = ivt490.ELEC_KW * cols["sum_pct"] / 100.0
+    cols["fan_kw"] = np.where(cols["b9"], ivt490.FAN_KW, 0.0)
+    cols["compressor_kw"] = np.where(cols["b5"], ivt490.COMP_KW, 0.0)
+    cols["circulation_pump_kw"] = np.where(cols["b8"], ivt490.PUMP_KW, 0.0)
+    cols["total_kw"] = cols["est_kw"] + cols["fan_kw"] + cols["compressor_kw"] + cols["circulation_pump_kw"]
+    return cols
+
+# Seconds each sample is taken to represent: the time to the next sample,
+# capped at MAX_GAP. The last sample of each day gets no time.
+def sampleDurations(cols, max_gap=MAX_GAP):
+    dt = np.diff(cols["time"], append=cols["time"][-1:])
+    if "day" in cols:
+        dt[np.diff(cols["day"], append=-1) != 0] = 0.0
+    return np.clip(dt, 0.0, max_gap)
+
+# Computes energy (kWh), compressor duty cycle and electric heater share of
+# the energy per day, in one pass over the columns from loadDays.
+def dailyReport(cols, first_day, ndays, max_gap=MAX_GAP):
+    if len(cols["time"]) == 0:
+        return []
+    dt = sampleDurations(cols, max_gap)
+    day = cols["day"]
+    seconds = np.bincount(day, weights=dt, minlength=ndays)
+    kwh = np.bincount(day, weights=cols["total_kw"] * dt, minlength=ndays) / 3600.0
+    est_kwh = np.bincount(day, weights=cols["est_kw"] * dt, minlength=ndays) / 3600.0
+    comp_secs = np.bincount(day, weights=cols["b5"] * dt, minlength=ndays)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        duty = np.where(seconds > 0, comp_secs / seconds, np.nan)
+        heater_share = np.where(kwh > 0, est_kwh / kwh, np.nan)
+    report = []
+    for i in range(ndays):
+        if seconds[i] > 0:
+            report.append({
+                "date": (first_day + timedelta(days=i)).isoformat(),
+                "hours": seconds[i] / 3600.0,
+                "kwh": kwh[i],
+                "heater_kwh": est_kwh[i],
+                "compressor_duty": duty[i],
+                "heater_share": heater_share[i]
+            })
+    return report
+
+def parseDay(s):
+    return datetime.strptime(s, "%Y%m%d").date()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"{sys.argv[0]} <base path> <first day YYYYMMDD> [last day YYYYMMDD]")
+        sys.exit(2)
+    first_day = parseDay(sys.argv[2])
+    last_day = parseDay(sys.argv[3]) if len(sys.argv) > 3 else first_day
+    cols = loadDays(sys.argv[1], first_day, last_day)
+    print("date;hours;kwh;heater_kwh;compressor_duty;heater_share")
+    for r in dailyReport(cols, first_day, (last_day - first_day).days + 1):
+        print("%s;%.2f;%.2f;%.2f;%.3f;%.3f" % (r["date"], r["hours"], r["kwh"], r["heater_kwh"], r["compressor_duty"], r["heater_share"]))
@@ -0,0 +1,85 @@
+
+# Compact binary format for IVT490 readings.
+#
+# A file starts with a 16 byte header (magic, field count) followed by
+# fixed-width little endian records: a float64 epoch and one int16 per
+# field of the CSV line written by ivt490d. Fields that can't be parsed
+# (e.g. the junk uptime values) are stored as MISSING.
+#
+# Usage:
+#   python ivt490bin.py import <YYYYMMDD.dat>...  - writes YYYYMMDD.bin next to each file
+#   python ivt490bin.py export <YYYYMMDD.bin>     - writes CSV lines to stdout
+
+import os
+import struct
+import sys
+
+MAGIC = b"IVT490B\x01"
+NFIELDS = 37
+MISSING = -32768
+
+header = struct.Struct("<8sII")
+
+def recordStruct(nfields=NFIELDS):
+    return struct.Struct("<d%dh" % (nfields, ))
+
+record = recordStruct()
+
+def encodeHeader(nfields=NFIELDS):
+    return header.pack(MAGIC, nfields, 0)
+
+# Returns the record struct for a file, given its first bytes.
+def decodeHeader(buf):
+    magic, nfields, _ = header.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("Not an IVT490 binary file")
+    return record if nfields == NFIELDS else recordStruct(nfields)
+
+def toInt16(field):
+    try:
+        value = int(field)
+    except ValueError:
+        return MISSING
+    return value if -32768 < value < 32768 else MISSING
+
+def encodeLine(csvLine):
+    parts = csvLine.split(";")
+    fields = [toInt16(f) for f in parts[1:NFIELDS + 1]]
+    fields += [MISSING] * (NFIELDS - len(fields))
+    return record.pack(float(parts[0]), *fields)
+
+def decodeToLine(rec):
+    fields = ["" if f == MISSING else str(f) for f in rec[1:]]
+    return "%s;%s" % (rec[0], ";".join(fields))
+
+def binPath(datPath):
+    return os.path.splitext(datPath)[0] + ".bin"
+
+def importFile(datPath):
+    with open(datPath, "r") as src, open(binPath(datPath), "wb") as dst:
+        dst.write(encodeHeader())
+        for line in src:
+            line = line.strip()
+            if line:
+                try:
+                    dst.write(encodeLine(line))
+                except ValueError:
+                    pass # unparseable timestamp
+
+def exportFile(path, out):
+    with open(path, "rb") as f:
+        buf = f.read()
+    rec = decodeHeader(buf)
+    end = header.size + (len(buf) - header.size) // rec.size * rec.size
+    for r in rec.iter_unpack(memoryview(buf)[header.size:end]):
+        out.write(decodeToLine(r) + "\n")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("import", "export"):
+        print(f"{sys.argv[0]} import <.dat file>... | export <.bin file>...")
+        sys.exit(2)
+    for path in sys.argv[2:]:
+        if sys.argv[1] == "import":
+            importFile(path)
+        else:
+            exportFile(path, sys.stdout)
@@ -0,0 +1,110 @@
+
+# Live feed of IVT490 readings from ivt490d to local consumers through a
+# shared memory ring, so they don't have to read the day files.
+#
+# The feed is a file in /dev/shm: a header (magic, slot count, record size,
+# sequence number) followed by slots holding ivt490bin records. The writer
+# fills slot seq % slots and then increments seq, so readers can check that
+# the slot they read wasn't overwritten meanwhile.
+
+import os
+import mmap
+import struct
+import threading
+import ivt490bin
+
+MAGIC = b"IVT490F\x01"
+FEEDPATH = "/dev/shm/ivt490.feed"
+SLOTS = 64
+
+header = struct.Struct("<8sIIQ")
+SEQ_OFFSET = 16
+
+class FeedWriter(object):
+    def __init__(self, path=FEEDPATH, slots=SLOTS):
+        self.slots = slots
+        size = header.size + slots * ivt490bin.record.size
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header.pack(MAGIC, slots, ivt490bin.record.size, 0))
+            f.truncate(size)
+        with open(tmp, "r+b") as f:
+            self.mm = mmap.mmap(f.fileno(), size)
+        # replace atomically so readers never see a half initialized feed
+        os.rename(tmp, path)
+        self.seq = 0
+
+    def publish(self, rec):
+        offset = header.size + (self.seq % self.slots) * len(rec)
+        self.mm[offset:offset + len(rec)] = rec
+        self.seq += 1
+        struct.pack_into("<Q", self.mm, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.mm.close()
+
+class FeedReader(object):
+    def __init__(self, path=FEEDPATH):
+        self.path = path
+        self.mm = None
+        self.ino = None
+        # the HTTP server reads from several threads and open() may remap
+        self.lock = threading.Lock()
+
+    # (Re)maps the feed, as the writer replaces it when ivt490d restarts.
+    def open(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self.mm is not None and st.st_ino == self.ino:
+            return True
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, size, _ = header.unpack_from(mm)
+        if magic != MAGIC or size != ivt490bin.record.size:
+            mm.close()
+            return False
+        self.mm = mm
+        self.ino = st.st_ino
+        return True
+
+    def sequence(self):
+        return struct.unpack_from("<Q", self.mm, SEQ_OFFSET)[0]
+
+    def read(self, seq):
+        offset = header.size + (seq % self.slots) * ivt490bin.record.size
+        return ivt490bin.record.unpack_from(self.mm, offset)
+
+    # Returns (sequence number, record) of the latest reading, or None.
+    def latest(self):
+        with self.lock:
+            if not self.open():
+                return None
+            while True:
+                seq = self.sequence()
+                if seq == 0:
+                    return None
+                rec = self.read(seq - 1)
+                if self.sequence() - seq < self.slots - 1:
+                    return seq, rec
+
+    # Returns the sequence number of the latest reading and the records after
+    # since (at most a full ring), for consumers following the feed.
+    def since(self, since):
+        with self.lock:
+            if not self.open():
+                return since, []
+            seq = self.sequence()
+            if since > seq:
+                since = 0 # the writer was restarted
+            first = max(since, seq - self.slots + 1)
+            recs = [self.read(i) for i in range(first, seq)]
+            if self.sequence() - first >= self.slots:
+                # the writer lapped us while reading, drop what may be overwritten
+                lost = self.sequence() - first - self.slots + 1
+                recs = recs[lost:]
+            return seq, recs
@@ -0,0 +1,226 @@
+
+# Incremental min/max/avg/last rollups of IVT490 readings at 5 minute, hourly
+# and daily resolution.
+#
+# Each tier is one file, rollup-<seconds>.bin, with the same kind of header
+# as ivt490bin (the reserved word holds the bucket size) followed by one
+# fixed-width record per closed bucket: float64 bucket start, uint32 sample
+# count and float32 min, max, avg and last for each field in FIELDS.
+# ivt490d appends to these as readings arrive (-r).
+#
+# The buckets still open are kept in rollup-open.json, saved whenever a 5
+# minute bucket closes and when ivt490d exits, so that after a restart they
+# are continued instead of being written with only the readings since.
+#
+# Usage:
+#   python ivt490rollup.py <base path> <first day YYYYMMDD>
+# rebuilds the tiers from the day files. Stop ivt490d while doing this.
+
+import os
+import json
+import mmap
+import struct
+import sys
+from datetime import datetime
+import ivt490
+import ivt490bin
+
+MAGIC = b"IVT490R\x01"
+TIERS = (300, 3600, 86400)
+# The finest tier with at most this many buckets in a range is used by default.
+MAX_POINTS = 2000
+
+# (group in ivt490.recordToDict, key) of each rolled up field. For flags,
+# avg is the fraction of samples with the flag set.
+FIELDS = (
+    ("temperatures", "gt1"),
+    ("temperatures", "gt2"),
+    ("temperatures", "gt3_1"),
+    ("temperatures", "gt3_2"),
+    ("temperatures", "gt3_3"),
+    ("temperatures", "gt6"),
+    ("temperatures", "estimated"),
+    ("flags", "compressor"),
+    ("flags", "circulation_pump"),
+    ("flags", "fan"),
+    ("flags", "alarm"),
+    ("power_draw", "sum_pct"),
+    ("power_draw", "rad_pct"),
+    ("power_draw", "vv_pct"),
+    ("power_draw", "est_kw"),
+    ("power_draw", "total_kw"),
+)
+
+bucket = struct.Struct("<dI%df" % (4 * len(FIELDS), ))
+
+def tierPath(dirpath, seconds):
+    return "%s/rollup-%d.bin" % (dirpath, seconds)
+
+def statePath(dirpath):
+    return "%s/rollup-open.json" % (dirpath, )
+
+# Start of the bucket containing t. Daily buckets start at local midnight.
+def bucketStart(t, seconds):
+    if seconds >= 86400:
+        return datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    return t - t % seconds
+
+def values(data):
+    return [float(data[group][key]) for group, key in FIELDS]
+
+class Tier(object):
+    def __init__(self, dirpath, seconds, state=None):
+        self.path = tierPath(dirpath, seconds)
+        self.seconds = seconds
+        self.start = None
+        self.count = 0
+        self.last_written = lastBucketStart(self.path)
+        if state is not None and (self.last_written is None or state["start"] > self.last_written):
+            self.start = state["start"]
+            self.count = state["count"]
+            self.mins = state["mins"]
+            self.maxs = state["maxs"]
+            self.sums = state["sums"]
+            self.lasts = state["lasts"]
+
+    # The open bucket, for Rollup.save
+    def state(self):
+        if self.count == 0:
+            return None
+        return {"start": self.start, "count": self.count, "mins": self.mins, "maxs": self.maxs, "sums": self.sums, "lasts": self.lasts}
+
+    # Returns True if a bucket was closed and written.
+    def add(self, t, vals):
+        start = bucketStart(t, self.seconds)
+        written = False
+        if start != self.start:
+            written = self.write()
+            self.start = start
+            self.count = 0
+            self.mins = list(vals)
+            self.maxs = list(vals)
+            self.sums = [0.0] * len(vals)
+        self.count += 1
+        for i, v in enumerate(vals):
+            if v < self.mins[i]:
+                self.mins[i] = v
+            elif v > self.maxs[i]:
+                self.maxs[i] = v
+            self.sums[i] += v
+        self.lasts = vals
+        return written
+
+    # Appends the current bucket, unless it's empty or not newer than the
+    # last one in the file (readings older than the rollups).
+    def write(self):
+        if self.count == 0 or (self.last_written is not None and self.start <= self.last_written):
+            return False
+        stats = []
+        for i in range(len(self.sums)):
+            stats += [self.mins[i], self.maxs[i], self.sums[i] / self.count, self.lasts[i]]
+        with open(self.path, "ab") as f:
+            if f.tell() == 0:
+                f.write(ivt490bin.header.pack(MAGIC, len(FIELDS), self.seconds))
+            f.write(bucket.pack(self.start, self.count, *stats))
+        self.last_written = self.start
+        return True
+
+# Keeps all tiers up to date. Buckets are written when the first reading of
+# the next bucket arrives, so the current bucket is never in the files.
+class Rollup(object):
+    def __init__(self, dirpath, tiers=TIERS):
+        self.statepath = statePath(dirpath)
+        state = loadState(self.statepath)
+        self.tiers = [Tier(dirpath, seconds, state.get(str(seconds))) for seconds in tiers]
+
+    def add(self, data):
+        vals = values(data)
+        written = False
+        for tier in self.tiers:
+            written = tier.add(data["time"], vals) or written
+        if written:
+            self.save()
+
+    # Saves the open buckets, to be continued by the next Rollup.
+    def save(self):
+        state = {str(tier.seconds): tier.state() for tier in self.tiers if tier.count > 0}
+        tmp = self.statepath + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.statepath)
+
+def loadState(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def checkHeader(buf):
+    magic, nfields, seconds = ivt490bin.header.unpack_from(buf)
+    if magic != MAGIC or nfields != len(FIELDS):
+        raise ValueError("Not an IVT490 rollup file")
+    return seconds
+
+def lastBucketStart(path):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        checkHeader(f.read(ivt490bin.header.size))
+        end = f.seek(0, os.SEEK_END)
+        count = (end - ivt490bin.header.size) // bucket.size
+        if count == 0:
+            return None
+        f.seek(ivt490bin.header.size + (count - 1) * bucket.size)
+        return bucket.unpack(f.read(bucket.size))[0]
+
+def bucketToDict(b):
+    data = {"time": b[0], "count": b[1]}
+    for i, (_, key) in enumerate(FIELDS):
+        data[key] = {"min": b[2 + 4 * i], "max": b[3 + 4 * i], "avg": b[4 + 4 * i], "last": b[5 + 4 * i]}
+    return data
+
+# Yields the buckets of a tier starting in [from_time, to_time).
+def readTier(dirpath, seconds, from_time, to_time):
+    try:
+        f = open(tierPath(dirpath, seconds), "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size < ivt490bin.header.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            checkHeader(mm)
+            count = (len(mm) - ivt490bin.header.size) // bucket.size
+            i = ivt490.findRecordIndex(mm, bucket, count, from_time)
+            while i < count:
+                b = bucket.unpack_from(mm, ivt490bin.header.size + i * bucket.size)
+                if b[0] >= to_time:
+                    break
+                yield bucketToDict(b)
+                i += 1
+
+def chooseTier(from_time, to_time, max_points=MAX_POINTS):
+    for seconds in TIERS:
+        if (to_time - from_time) / seconds <= max_points:
+            return seconds
+    return TIERS[-1]
+
+def rebuild(basepath, first_day):
+    for path in [tierPath(basepath, seconds) for seconds in TIERS] + [statePath(basepath)]:
+        if os.path.exists(path):
+            os.remove(path)
+    rollup = Rollup(basepath)
+    from_time = datetime.combine(first_day, datetime.min.time()).timestamp()
+    for data in ivt490.readHistory(basepath, from_time, datetime.now().timestamp()):
+        rollup.add(data)
+    # for ivt490d to continue from
+    rollup.save()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"{sys.argv[0]} <base path> <first day YYYYMMDD>")
+        sys.exit(2)
+    rebuild(sys.argv[1], datetime.strptime(sys.argv[2], "%Y%m%d").date())
@@ -1,23 +1,171 @@
-from ivt490 import latestLineAsJson
-from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import os
+import sys
+# The metrics module is shared with the collectors in the parent directory.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ivt490 import latestRecord, readHistory
+from ivt490rollup import readTier, chooseTier, TIERS
+from ivt490feed import FeedReader, FEEDPATH
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import json
+import math
+import metrics
+import time
+import zlib
 
 port = 10490
 basepath = "/media/passport/dump/ivt490"
+# Live feed from ivt490d (-m), used for the latest reading when present.
+feedpath = FEEDPATH
+
+# Responses at least this large are gzipped if the client accepts it.
+GZIP_MIN_SIZE = 1400
+# History is streamed in chunks of about this size.
+CHUNK_SIZE = 16384
+# Times in queries must be before this, the end of a 32-bit unsigned time_t
+MAX_TIME = 2 ** 32
+
+ENDPOINTS = ("/", "/history", "/rollup", "/metrics")
+REQUEST_SECONDS = metrics.histogram("ivt490_server_request_seconds", "Time to handle a request", ("path", ))
 
 class MyHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 gives us keep-alive; idle connections are closed after timeout seconds.
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    # Headers and body are written separately, don't let Nagle delay the body
+    # until the client's delayed ACK on kept-alive connections.
+    disable_nagle_algorithm = True
+    feed = None
+
     def do_GET(self):
-        json = latestLineAsJson(basepath)
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path == "/history":
+            self.send_history(parse_qs(url.query))
+        elif url.path == "/rollup":
+            self.send_rollup(parse_qs(url.query))
+        elif url.path == "/metrics":
+            self.send_metrics()
+        else:
+            data, body = latestRecord(basepath, self.feed)
+            self.send_json(body, etag='"%s"' % (data["time"], ))
+        REQUEST_SECONDS.labels(url.path if url.path in ENDPOINTS else "/").since(start)
+
+    def send_metrics(self):
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def accepts_gzip(self):
+        return "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def send_json(self, body, etag=None):
+        if etag is not None and etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        gzipped = len(body) >= GZIP_MIN_SIZE and self.accepts_gzip()
+        if gzipped:
+            body = zlib.compress(body, wbits=31)
+
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def write_chunk(self, chunk):
+        if chunk:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+    # Epoch seconds from a query parameter. Raises ValueError for values
+    # the readers can't turn into dates (nan, inf, 1e20), so that they get
+    # a 400 instead of a body that ends half way.
+    @staticmethod
+    def query_time(query, name, default=None):
+        if name not in query and default is not None:
+            return default
+        t = float(query[name][0])
+        if not 0 <= t < MAX_TIME:
+            raise ValueError(f"{name} out of range")
+        return t
+
+    # GET /history?from=<epoch>&to=<epoch>&step=<seconds>
+    # 'to' defaults to now and 'step' to 0 (all records).
+    def send_history(self, query):
+        try:
+            from_time = self.query_time(query, "from")
+            to_time = self.query_time(query, "to", time.time())
+            step = float(query.get("step", [0])[0])
+            if not math.isfinite(step):
+                raise ValueError("step is not finite")
+        except (KeyError, ValueError):
+            self.send_error(400, "Expected from=<epoch>[&to=<epoch>][&step=<seconds>]")
+            return
+
+        self.send_records(readHistory(basepath, from_time, to_time, step))
+
+    # GET /rollup?from=<epoch>&to=<epoch>&tier=<seconds>
+    # 'to' defaults to now. Without 'tier', the finest tier that gives a
+    # reasonable number of buckets for the range is used.
+    def send_rollup(self, query):
+        try:
+            from_time = self.query_time(query, "from")
+            to_time = self.query_time(query, "to", time.time())
+            tier = int(query["tier"][0]) if "tier" in query else chooseTier(from_time, to_time)
+        except (KeyError, ValueError):
+            tier = None
+        if tier not in TIERS:
+            self.send_error(400, "Expected from=<epoch>[&to=<epoch>][&tier=<%s>]" % ("|".join(map(str, TIERS)), ))
+            return
+
+        self.send_records(readTier(basepath, tier, from_time, to_time))
+
+    def send_records(self, records):
+        gzipped = self.accepts_gzip()
+        compressor = zlib.compressobj(wbits=31) if gzipped else None
 
         self.send_response(200)
         self.send_header("Content-type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
         self.end_headers()
 
-        self.wfile.write(bytes(json, "utf-8"))
+        # Stream the records as a JSON array without collecting them first.
+        buf = bytearray()
+        sep = b"["
+        for data in records:
+            buf += sep
+            buf += json.dumps(data).encode()
+            sep = b","
+            if len(buf) >= CHUNK_SIZE:
+                self.write_chunk(compressor.compress(buf) if gzipped else bytes(buf))
+                buf.clear()
+        buf += b"[]" if sep == b"[" else b"]"
+        if gzipped:
+            self.write_chunk(compressor.compress(buf) + compressor.flush())
+        else:
+            self.write_chunk(bytes(buf))
+        self.wfile.write(b"0\r\n\r\n")
 
 def run():
     print(f"Starting HTTP server on port {port}")
     server_address = ('', port)
-    httpd = HTTPServer(server_address, MyHandler)
+    MyHandler.feed = FeedReader(feedpath)
+    httpd = ThreadingHTTPServer(server_address, MyHandler)
     httpd.serve_forever()
 
 if __name__ == "__main__":
@@ -20,6 +20,14 @@ from threading import Event
 from datetime import datetime
 from subprocess import Popen
 
+# The binary record format and rollups live with the readers in ivt490_server.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ivt490_server"))
+import metrics
+import ivt490
+import ivt490bin
+import ivt490feed
+import ivt490rollup
+
 # Default options
 PIDFILE = 'ivt490.pid'
 SEROPTS = {
@@ -29,39 +37,157 @@ SEROPTS = {
   }
 LOGFILE = "ivt490.log"
 DONE_WAIT = 7
+FLUSH_INTERVAL = 0
+
+LINES = metrics.counter("ivt490d_lines_total", "Lines read from the serial port")
+EMPTY_LINES = metrics.counter("ivt490d_empty_lines_total", "Empty or NUL lines read from the serial port (timeouts)")
+JUNK_LINES = metrics.counter("ivt490d_junk_lines_total", "Lines that could not be decoded for the rollups")
+SERIAL_ERRORS = metrics.counter("ivt490d_serial_errors_total", "Errors opening or reading the serial port")
+PUBLISH_SECONDS = metrics.histogram("ivt490d_publish_seconds", "Time to write a reading to all outputs")
+FLUSH_SECONDS = metrics.histogram("ivt490d_flush_seconds", "Time to write (and fsync) buffered data", ("file", ))
+
+# Appends text to a file that is kept open between writes. If rotate is set,
+# the path is run through strftime and the file is reopened when the result
+# changes. Writes are batched and flushed at most every flush_interval seconds,
+# optionally followed by an fsync. If given, header is written first to each
+# new (empty) file. The time taken is observed in the flush_seconds histogram.
+class Writer(object):
+  def __init__(self, path, rotate=False, flush_interval=0, fsync=False, header=None, flush_seconds=None):
+    self.pattern = path
+    self.flush_seconds = flush_seconds
+    self.header = header
+    self.rotate = rotate
+    self.flush_interval = flush_interval
+    self.fsync = fsync
+    self.path = None if rotate else path
+    self.fd = None
+    self.pending = []
+    self.last_flush = time.time()
+
+  def write(self, data, now=None):
+    if now is None:
+      now = time.time()
+    if self.rotate:
+      path = time.strftime(self.pattern, time.localtime(now))
+      if path != self.path:
+        self.close()
+        self.path = path
+    self.pending.append(data.encode() if isinstance(data, str) else data)
+    if now - self.last_flush >= self.flush_interval:
+      self.flush(now)
+
+  # Flushes if the flush interval has passed, for when no writes are coming.
+  def tick(self):
+    now = time.time()
+    if self.pending and now - self.last_flush >= self.flush_interval:
+      self.flush(now)
+
+  def flush(self, now=None):
+    self.last_flush = now or time.time()
+    if not self.pending:
+      return
+    start = time.perf_counter()
+    data = b"".join(self.pending)
+    self.pending = []
+    if self.fd is None:
+      self.fd = open(self.path, "ab", buffering=0)
+      if self.header is not None and self.fd.tell() == 0:
+        self.fd.write(self.header)
+    self.fd.write(data)
+    if self.fsync:
+      os.fsync(self.fd.fileno())
+    if self.flush_seconds is not None:
+      self.flush_seconds.since(start)
+
+  def close(self):
+    self.flush()
+    if self.fd is not None:
+      self.fd.close()
+      self.fd = None
 
 class App(object):
-  def __init__(self, logfile, outputfile, port, foreground):
+  def __init__(self, logfile, outputfile, port, foreground, flush_interval=FLUSH_INTERVAL, fsync=False, binaryfile=None, rollupdir=None, feedpath=None, metrics_port=None):
     self.logfile = os.path.abspath(logfile)
-    self.outputfile = os.path.abspath(outputfile)
+    self.outputfile = outputfile if outputfile in (None, "-") else os.path.abspath(outputfile)
+    self.binaryfile = binaryfile and os.path.abspath(binaryfile)
     self.port = port
     self.ser = None
     self.running = True
     self.foreground = foreground
+    self.logwriter = Writer(self.logfile)
+    self.outputwriter = Writer(self.outputfile, rotate=True, flush_interval=flush_interval, fsync=fsync,
+                               flush_seconds=FLUSH_SECONDS.labels("output"))
+    self.binarywriter = Writer(self.binaryfile, rotate=True, flush_interval=flush_interval, fsync=fsync,
+                               header=ivt490bin.encodeHeader(), flush_seconds=FLUSH_SECONDS.labels("binary"))
+    self.rollupdir = rollupdir and os.path.abspath(rollupdir)
+    self.rollup = None
+    self.feedpath = feedpath
+    self.feed = None
+    self.metrics_port = metrics_port
 
   def log(self, msg):
     text = "%s: %s\n" % (str(datetime.now()), msg)
-    with open(self.logfile, 'a') as f:
-      f.write(text)
+    self.logwriter.write(text)
     if self.foreground:
       sys.stdout.write(text)
 
+  def close_files(self):
+    if self.rollup is not None:
+      try:
+        self.rollup.save()
+      except OSError as e:
+        self.log("ERROR saving the open rollup buckets: " + str(e))
+    self.outputwriter.close()
+    self.binarywriter.close()
+    self.logwriter.close()
+
   def log_init(self):
     self.log("*** IVT490 readings daemon starting with options:")
     self.log("Log file = " + self.logfile)
-    self.log("Output file = " + self.outputfile)
+    self.log("Output file = " + str(self.outputfile))
+    self.log("Binary output file = " + str(self.binaryfile))
+    self.log("Rollup directory = " + str(self.rollupdir))
+    self.log("Live feed = " + str(self.feedpath))
     self.log("Serial port = " + self.port)
+    self.log("Flush interval = %s s%s" % (self.outputwriter.flush_interval, " (with fsync)" if self.outputwriter.fsync else ""))
+    self.log("Metrics port = " + str(self.metrics_port))
+
+  # Started after daemonizing, as DaemonContext closes open sockets too.
+  def serve_metrics(self):
+    if self.metrics_port:
+      metrics.serve(self.metrics_port)
 
   def publish(self, line):
+    start = time.perf_counter()
     secs = time.time()
     csv = ";".join([field.strip() for field in line.split(";")])
     line = "%s;%s" % (secs, csv)
     if self.outputfile == "-":
       sys.stdout.write(line + "\n")
-    else:
-      ofile = time.strftime(self.outputfile, time.localtime())
-      with open(ofile, "a") as fd:
-        fd.write(line + "\n")
+    elif self.outputfile:
+      self.outputwriter.write(line + "\n", secs)
+    if self.binaryfile or self.feedpath:
+      rec = ivt490bin.encodeLine(line)
+      if self.binaryfile:
+        self.binarywriter.write(rec, secs)
+      if self.feedpath:
+        # created on first use, since DaemonContext closes open files
+        if self.feed is None:
+          self.feed = ivt490feed.FeedWriter(self.feedpath)
+        self.feed.publish(rec)
+    if self.rollupdir:
+      self.update_rollup(line)
+    PUBLISH_SECONDS.since(start)
+
+  def update_rollup(self, line):
+    try:
+      data = ivt490.lineToDict(line)
+    except (IndexError, ValueError):
+      JUNK_LINES.inc()
+      return # junk line
+    if self.rollup is None:
+      self.rollup = ivt490rollup.Rollup(self.rollupdir)
+    self.rollup.add(data)
 
   def open_serial(self):
     try:
@@ -70,10 +196,13 @@ class App(object):
       self.log("Opening " + self.port + "...")
       self.ser = serial.Serial(**opts)
     except Exception as e:
+      SERIAL_ERRORS.inc()
       self.log("ERROR opening serial port: " + str(e))
 
+  # Only stops the listen loop, which ends within the serial timeout and
+  # then flushes and closes the files. Writing from the handler could
+  # interrupt a write in progress.
   def safe_exit(self, *args):
-    self.log("Caught TERM signal, exiting...")
     self.running = False
 
   def listen(self):
@@ -84,42 +213,69 @@ class App(object):
         line = self.ser.readline()
         line = line.decode("ascii")
         if len(line) > 0 and line[0] != "\x00":
+          LINES.inc()
           self.publish(line.rstrip())
+        else:
+          EMPTY_LINES.inc()
+        self.outputwriter.tick()
+        self.binarywriter.tick()
     except KeyboardInterrupt:
       self.log("Interrupted by user!")
     except:
+      SERIAL_ERRORS.inc()
       self.log("ERROR reading from serial port: " + str(sys.exc_info()[1]))
       exitCode = 1
 
+    if not self.running:
+      self.log("Caught TERM signal, exiting...")
     if self.ser:
       try:
         self.ser.close()
       except:
         pass # ignore
     self.log("Listen loop ended, exit code = %d." % (exitCode, ))
+    self.close_files()
     return exitCode
 
 
 def usage():
-  print(sys.argv[0] + ' [-h][-f] [-l log file] [-p pid_file] [-o receiver script] [-s serial port]')
+  print(sys.argv[0] + ' [-h][-f][-y] [-l log file] [-p pid_file] [-o receiver script] [-b binary file] [-r rollup dir] [-m feed] [-s serial port] [-F flush interval] [-P metrics port]')
   print('\t-l  : path to file that will receive log messages (default %s)' % (LOGFILE, ))
   print('\t-p  : path to file that will receive the daemon PID (default %s)' % (PIDFILE, ))
   print('\t-o  : path to file to which readings will be appended - will be run through strftime')
+  print('\t-b  : path to file to which readings will be appended in binary format (see ivt490_server/ivt490bin.py) - will be run through strftime')
+  print('\t-r  : directory in which to maintain 5 min/hourly/daily rollups (see ivt490_server/ivt490rollup.py)')
+  print('\t-m  : shared memory file to publish readings to for local consumers (e.g. %s)' % (ivt490feed.FEEDPATH, ))
   print('\t-s  : serial port to get readings from (at %d baud, default %s)' % (SEROPTS["baudrate"], SEROPTS["port"], ))
+  print('\t-F  : seconds to buffer readings before writing them to the output file (default %d)' % (FLUSH_INTERVAL, ))
+  print('\t-y  : fsync the output file after each write')
+  print('\t-P  : serve metrics on http://localhost:<port>/metrics')
   print("\t-f  : don't detach (run in foreground)")
   print('\t-h  : display this help')
 
 
 def start():
-  opts, args = getopt.getopt(sys.argv[1:], 'o:p:l:hfs:')
+  opts, args = getopt.getopt(sys.argv[1:], 'o:p:l:hfs:F:yb:r:m:P:')
   pidfile = PIDFILE
   logfile = LOGFILE
   outputfile = None
+  binaryfile = None
+  rollupdir = None
+  feedpath = None
   serport = SEROPTS["port"]
   foreground = False
+  flush_interval = FLUSH_INTERVAL
+  fsync = False
+  metrics_port = None
   for o, a in opts:
     if o == '-o':
       outputfile = a
+    elif o == '-b':
+      binaryfile = a
+    elif o == '-r':
+      rollupdir = a
+    elif o == '-m':
+      feedpath = a
     elif o == '-p':
       pidfile = a
     elif o == '-l':
@@ -128,19 +284,28 @@ def start():
       serport = a
     elif o == '-f':
       foreground = True
+    elif o == '-F':
+      flush_interval = float(a)
+    elif o == '-y':
+      fsync = True
+    elif o == '-P':
+      metrics_port = int(a)
     elif o == '-h':
       usage()
       sys.exit(1)
-  if not outputfile:
+  if not outputfile and not binaryfile and not feedpath:
     print("Missing output file.")
     usage()
     sys.exit(2)
 
-  a = App(logfile=logfile, outputfile=outputfile, port=serport, foreground=foreground)
+  a = App(logfile=logfile, outputfile=outputfile, port=serport, foreground=foreground,
+          flush_interval=flush_interval, fsync=fsync, binaryfile=binaryfile, rollupdir=rollupdir, feedpath=feedpath,
+          metrics_port=metrics_port)
   a.log_init()
 
   if foreground:
     a.log("Foreground mode")
+    a.serve_metrics()
     a.open_serial()
     exitCode = a.listen()
     if exitCode > 0:
@@ -155,8 +320,11 @@ def start():
     context.signal_map = {
       signal.SIGTERM: a.safe_exit
       }
+    # DaemonContext closes all open files; they are reopened on the next write.
+    a.close_files()
     with context:
       a.log("Successfully daemonized!")
+      a.serve_metrics()
       a.open_serial()
       a.listen()
 
@@ -0,0 +1,189 @@
+import bisect
+import http.server
+import threading
+import time
+
+# Counters, gauges and histograms in the Prometheus text format, cheap
+# enough to update on every line, packet and request: an update is an
+# attribute add or a bisect over a few bucket bounds, well under a
+# microsecond. Updates aren't locked; with the GIL a concurrent increment
+# can very rarely be lost, which is fine for monitoring.
+#
+# Metrics can also be backed by a function, read when scraped, for values
+# that are already counted elsewhere (e.g. defa_packet.Decoder.packets) so
+# the hot path doesn't pay anything extra.
+
+# Latency buckets in seconds, from 10 us to 10 s
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        return [f"{name}{labels} {self.value}"]
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def samples(self, name, labels):
+        return [f"{name}{labels} {self.value}"]
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    # Observes the seconds since start, a time.perf_counter() value.
+    def since(self, start):
+        self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        lines = []
+        total = 0
+        inner = labels[1:-1] + "," if labels else ""
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{inner}le="{bound}"}} {total}')
+        total += self.counts[-1]
+        lines.append(f'{name}_bucket{{{inner}le="+Inf"}} {total}')
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {total}")
+        return lines
+
+# A value read from a function when scraped.
+class Func:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def samples(self, name, labels):
+        return [f"{name}{labels} {self.fn()}"]
+
+# A named metric with its help text, and one child metric per label values.
+class Family:
+    def __init__(self, name, kind, help, labelnames, factory):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            lines += child.samples(self.name, format_labels(self.labelnames, values))
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, kind, help, labelnames, factory):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(name, kind, help, labelnames, factory)
+        # without labels the family has a single child, returned directly
+        return family if labelnames else family.labels()
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(name, "counter", help, labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self.add(name, "gauge", help, labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(name, "histogram", help, labelnames, lambda: Histogram(buckets))
+
+    def counter_func(self, name, help, fn):
+        return self.add(name, "counter", help, (), lambda: Func(fn))
+
+    def gauge_func(self, name, help, fn):
+        return self.add(name, "gauge", help, (), lambda: Func(fn))
+
+    def render(self):
+        lines = []
+        for family in list(self.families.values()):
+            lines += family.render()
+        return ("\n".join(lines) + "\n").encode()
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+counter_func = REGISTRY.counter_func
+gauge_func = REGISTRY.gauge_func
+render = REGISTRY.render
+
+# Measures how late an asyncio event loop runs a callback scheduled every
+# interval seconds, i.e. how long callbacks block the loop.
+def watch_loop_lag(loop, interval=1.0, name="event_loop_lag_seconds"):
+    lag = histogram(name, "Delay of a periodic event loop callback past its scheduled time")
+    def check(expected):
+        now = loop.time()
+        lag.observe(max(0.0, now - expected))
+        loop.call_at(now + interval, check, now + interval)
+    loop.call_at(loop.time() + interval, check, loop.time() + interval)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scraped every few seconds, not worth logging
+
+# Serves /metrics from a background thread, for the collectors that don't
+# have an HTTP server of their own. Listens on localhost by default.
+def serve(port, address="127.0.0.1"):
+    httpd = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
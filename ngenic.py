@@ -1,52 +1,195 @@
+import getopt
 import http.client
 import json
 import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 HOST = "app.ngenic.se"
 API_BASE = "/api/v3"
 
+# Number of concurrent requests, and connections kept open for them
+POOL_SIZE = 8
+# Seconds to cache data that rarely changes: the tune, its nodes and rooms,
+# and the measurement types of each node
+CACHE_TTL = 3600
+# Seconds between polls in daemon mode
+POLL_INTERVAL = 60
+
 def read_pat():
     config_path = os.path.expanduser("~/.ngenic")
     with open(config_path, "r") as file:
         return file.readline().strip()
 
-# Read the Personal Access token
-PAT = read_pat()
-
-connection = http.client.HTTPSConnection(HOST)
-headers = {
-    "Authorization": f"Bearer {PAT}"
-}
-
-def call_api(endpoint):
-    connection.request("GET", f"{API_BASE}{endpoint}", headers=headers)
-    response = connection.getresponse()
-    ct = response.getheader("Content-Type")
-    body = response.read().decode()
-    if ct is not None and ct.startswith("application/json"):
-        return json.loads(body)
-    return body
-
-
-# Get tunes - we expect a single one
-tunes = call_api("/tunes")
-if len(tunes) != 1:
-    raise Exception(f"Unexpected tunes count: {len(tunes)}")
-tune = tunes[0]
-tuneId = tune["tuneUuid"]
-
-nodes = call_api(f"/tunes/{tuneId}/gateway/nodes")
-print(nodes)
-
-rooms = call_api(f"/tunes/{tuneId}/rooms")
-for room in rooms:
-    name = room["name"]
-    print(f"Room {name}")
-    nodeId = room["nodeUuid"]
-    types = call_api(f"/tunes/{tuneId}/measurements/{nodeId}/types")
-    for type in types:
-        value = call_api(f"/tunes/{tuneId}/measurements/{nodeId}/latest?type={type}")
-        print(f"- type {type}: {value}")
-
-
-connection.close()
+# Client for the Ngenic API. Requests are spread over a small pool of
+# keep-alive connections so that the per-room and per-type requests of a
+# poll run concurrently.
+class Client:
+    def __init__(self, pat, pool_size=POOL_SIZE, cache_ttl=CACHE_TTL):
+        self.headers = {
+            "Authorization": f"Bearer {pat}"
+        }
+        self.cache_ttl = cache_ttl
+        self.cache = {} # endpoint -> (expiry time, value)
+        self.cache_lock = threading.Lock()
+        self.connections = queue.LifoQueue()
+        for _ in range(pool_size):
+            self.connections.put(None) # opened when first used
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def request(self, connection, endpoint):
+        connection.request("GET", f"{API_BASE}{endpoint}", headers=self.headers)
+        response = connection.getresponse()
+        ct = response.getheader("Content-Type")
+        body = response.read().decode()
+        if response.status != 200:
+            raise Exception(f"{endpoint} returned {response.status}: {body}")
+        if ct is not None and ct.startswith("application/json"):
+            return json.loads(body)
+        return body
+
+    def call_api(self, endpoint):
+        connection = self.connections.get()
+        try:
+            if connection is None:
+                connection = http.client.HTTPSConnection(HOST)
+            try:
+                return self.request(connection, endpoint)
+            except (http.client.HTTPException, OSError):
+                # the server may have closed an idle connection, retry once on a new one
+                connection.close()
+                connection = http.client.HTTPSConnection(HOST)
+                return self.request(connection, endpoint)
+        finally:
+            self.connections.put(connection)
+
+    def cached_call(self, endpoint):
+        now = time.monotonic()
+        with self.cache_lock:
+            entry = self.cache.get(endpoint)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = self.call_api(endpoint)
+        with self.cache_lock:
+            self.cache[endpoint] = (now + self.cache_ttl, value)
+        return value
+
+    # Calls fn for each item concurrently, returning the results in order.
+    def fan_out(self, fn, items):
+        return list(self.executor.map(fn, items))
+
+    # We expect a single tune
+    def tune(self):
+        tunes = self.cached_call("/tunes")
+        if len(tunes) != 1:
+            raise Exception(f"Unexpected tunes count: {len(tunes)}")
+        return tunes[0]
+
+    def tune_id(self):
+        return self.tune()["tuneUuid"]
+
+    def nodes(self):
+        return self.cached_call(f"/tunes/{self.tune_id()}/gateway/nodes")
+
+    def rooms(self):
+        return self.cached_call(f"/tunes/{self.tune_id()}/rooms")
+
+    def types(self, node_id):
+        return self.cached_call(f"/tunes/{self.tune_id()}/measurements/{node_id}/types")
+
+    def latest(self, node_id, type):
+        return self.call_api(f"/tunes/{self.tune_id()}/measurements/{node_id}/latest?type={type}")
+
+    # Returns the latest measurements as { room name: { type: value } }.
+    # Once the rooms and types are cached this is a single round of
+    # concurrent requests.
+    def poll(self):
+        rooms = self.rooms()
+        room_types = self.fan_out(lambda room: self.types(room["nodeUuid"]), rooms)
+        requests = [(room["name"], room["nodeUuid"], type) for room, types in zip(rooms, room_types) for type in types]
+        values = self.fan_out(lambda r: self.latest(r[1], r[2]), requests)
+        result = {}
+        for (name, _, type), value in zip(requests, values):
+            result.setdefault(name, {})[type] = value
+        return result
+
+    def close(self):
+        self.executor.shutdown()
+        while not self.connections.empty():
+            connection = self.connections.get()
+            if connection is not None:
+                connection.close()
+
+# Writes a line to the output file, "-" for stdout, allowing date/time
+# formatting in its name like slimmelezer does.
+def write_line(path, line):
+    if path == "-":
+        print(line, flush=True)
+        return
+    with open(time.strftime(path), "a") as f:
+        f.write(line)
+        f.write("\n")
+
+# Polls every interval seconds, writing each result as a JSON line.
+def run_daemon(client, output, interval):
+    while True:
+        start = time.monotonic()
+        try:
+            state = client.poll()
+            state["seconds"] = time.time()
+            write_line(output, json.dumps(state))
+        except Exception as e:
+            print(f"Poll failed: {e}", file=sys.stderr, flush=True)
+        time.sleep(max(0, interval - (time.monotonic() - start)))
+
+def print_once(client):
+    print(client.nodes())
+    for name, values in client.poll().items():
+        print(f"Room {name}")
+        for type, value in values.items():
+            print(f"- type {type}: {value}")
+
+def usage():
+    print(f"{sys.argv[0]} [-h] [-d] [-o output file] [-i interval] [-c connections]")
+    print(f"\t-d  : daemon mode, poll and write JSON lines instead of printing once")
+    print(f"\t-o  : path to file that will receive JSON lines in daemon mode (default -, stdout)")
+    print(f"\t-i  : seconds between polls in daemon mode (default {POLL_INTERVAL})")
+    print(f"\t-c  : number of concurrent connections (default {POOL_SIZE})")
+    print(f"\t-h  : show this help")
+
+def main():
+    daemon = False
+    output = "-"
+    interval = POLL_INTERVAL
+    pool_size = POOL_SIZE
+    optss, args = getopt.getopt(sys.argv[1:], 'hdo:i:c:')
+    for o, a in optss:
+        if o == "-d":
+            daemon = True
+        elif o == "-o":
+            output = os.path.abspath(a)
+        elif o == "-i":
+            interval = float(a)
+        elif o == "-c":
+            pool_size = int(a)
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    # Read the Personal Access token
+    client = Client(read_pat(), pool_size)
+    try:
+        if daemon:
+            run_daemon(client, output, interval)
+        else:
+            print_once(client)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
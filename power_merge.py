@@ -0,0 +1,323 @@
+import getopt
+import glob
+import heapq
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+# The IVT490 history reader lives in ivt490_server.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ivt490_server"))
+import ivt490
+
+# Merges the heat pump's modeled power, the P1 meter's per-phase power from
+# slimmelezer and the mains phase currents measured by the DEFA load
+# balancer into one time aligned stream, e.g. to see the household load the
+# heat pump doesn't explain. The DEFA currents are those of the whole house,
+# the car's charging included, the same as the meter measures.
+#
+# Each source yields (time, key, values) in time order, reading its files
+# line by line. The sources are merged by time with heapq.merge and joined
+# as of each output time, keeping only the latest values per key (and the
+# sums of the current step when averaging), so memory doesn't grow with the
+# length of the range. Values are tracked per field, each going missing
+# TOLERANCE seconds after it was last updated.
+#
+# slimmelezer output recorded with -c deadband or swingingdoor only has the
+# points where a series changed, so a steady value isn't stale. Those
+# series are read as segments between recorded points: held until the next
+# point for deadband, and linear to it for swinging door, as recorded.
+
+VOLTAGE = 230.0
+# Share of the heat pump's power drawn from each phase
+HEATPUMP_PHASES = (1 / 3, 1 / 3, 1 / 3)
+# Values older than this many seconds are considered missing
+TOLERANCE = 300
+METER_PHASES = ("power_consumed_phase_1", "power_consumed_phase_2", "power_consumed_phase_3")
+DEFA_PHASES = ("phase1_amps", "phase2_amps", "phase3_amps")
+METER_MODES = ("tick", "deadband", "swingingdoor")
+
+# A recorded point of a change-recording series and the next one, at t1,
+# which is None after the last point.
+Segment = namedtuple("Segment", ["t0", "v0", "t1", "v1"])
+
+# Value of a segment at t0 <= t <= t1.
+def segment_value(segment, t):
+    if segment.t1 is None or segment.t1 == segment.t0:
+        return segment.v0
+    return segment.v0 + (segment.v1 - segment.v0) * (t - segment.t0) / (segment.t1 - segment.t0)
+
+# Value at t of a field last updated at updated, or None if it's missing.
+# Segments are valid until their next point, or for tolerance after the last.
+def field_value(updated, value, t, tolerance):
+    if isinstance(value, Segment):
+        if value.t1 is not None and t <= value.t1:
+            return segment_value(value, t)
+        return value.v0 if value.t1 is None and t - value.t0 <= tolerance else None
+    return value if t - updated <= tolerance else None
+
+# Time until which a segment is valid, see field_value.
+def segment_end(segment, tolerance):
+    return segment.t0 + tolerance if segment.t1 is None else segment.t1
+
+def heatpump_source(basepath, from_time, to_time):
+    for data in ivt490.readHistory(basepath, from_time, to_time):
+        yield (data["time"], "heatpump", { "heatpump_kw": data["power_draw"]["total_kw"] })
+
+# Yields the JSON objects of the lines of the files in order.
+def json_lines(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.startswith("data:"):
+                    line = line[5:] # saved from an event stream
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue # junk line
+
+# slimmelezer output recorded as ticks with all object IDs.
+def meter_ticks(paths, from_time, to_time):
+    for data in json_lines(paths):
+        t = data.get("seconds")
+        if t is None or t < from_time:
+            continue
+        if t >= to_time:
+            break
+        values = { k: float(v["value"]) for k, v in data.items() if isinstance(v, dict) and "value" in v }
+        if values:
+            yield (t, "meter", values)
+
+# The recorded points of one object ID of change-recording slimmelezer
+# output, as Segments to the next point, from the last point before
+# from_time. Held (deadband) or linear (swinging door) segments.
+def meter_segments(paths, field, from_time, to_time, linear):
+    previous = None
+    for data in json_lines(paths):
+        t = data.get("seconds")
+        if t is None or not isinstance(data.get(field), dict) or "value" not in data[field]:
+            continue
+        value = float(data[field]["value"])
+        if previous is not None and t > from_time:
+            yield (previous[0], "meter", { field: Segment(previous[0], previous[1], t, value if linear else previous[1]) })
+        if t >= to_time:
+            return
+        previous = (t, value)
+    if previous is not None:
+        yield (previous[0], "meter", { field: Segment(previous[0], previous[1], None, None) })
+
+# slimmelezer output in any of METER_MODES. Change-recording output is read
+# once per phase, so that each series can look ahead to its next point
+# without buffering the others.
+def meter_source(paths, from_time, to_time, mode="tick"):
+    if mode == "tick":
+        return meter_ticks(paths, from_time, to_time)
+    return merge([meter_segments(paths, field, from_time, to_time, mode == "swingingdoor") for field in METER_PHASES])
+
+# DEFA readings as served by defa_lb_server, one JSON object per line.
+def defa_source(paths, from_time, to_time, serial=None):
+    for data in json_lines(paths):
+        if serial is not None and data.get("serial") != serial:
+            continue
+        try:
+            t = datetime.fromisoformat(data["timestamp_utc"]).replace(tzinfo=timezone.utc).timestamp()
+        except (KeyError, ValueError):
+            continue
+        if t < from_time:
+            continue
+        if t >= to_time:
+            break
+        # one key per load balancer, averaged in derive()
+        yield (t, "defa " + data.get("serial", ""), { k: data[k] for k in DEFA_PHASES if k in data })
+
+# Joins the merged events as of start, start + step, ... < end. With
+# mean, each output averages the values of [time, time + step) instead,
+# falling back to the latest value for fields without any. Segments
+# are averaged over the time they cover in the step. With step 0, a record
+# is produced for every event.
+def align(events, start, end, step, mean=False, tolerance=TOLERANCE):
+    latest = {} # key -> { field: (time, value) }
+    sums = {} # key -> { field: [sum, weight] }
+
+    def update(t, key, values):
+        fields = latest.setdefault(key, {})
+        for field, value in values.items():
+            if mean:
+                previous = fields.get(field)
+                if previous is not None and isinstance(previous[1], Segment):
+                    # the previous segment ends here, or earlier
+                    add_segment(key, field, previous[1], t)
+                if not isinstance(value, Segment):
+                    add(key, field, value, 1)
+            fields[field] = (t, value)
+
+    def add(key, field, value, weight):
+        total = sums.setdefault(key, {}).setdefault(field, [0.0, 0])
+        total[0] += value * weight
+        total[1] += weight
+
+    # Adds the part of the segment within the step starting at t_step,
+    # up to limit.
+    def add_segment(key, field, segment, limit):
+        a = max(segment.t0, t_step)
+        b = min(segment_end(segment, tolerance), limit)
+        if b > a:
+            add(key, field, (segment_value(segment, a) + segment_value(segment, b)) / 2, b - a)
+
+    def snapshot(t):
+        result = {}
+        for key, fields in latest.items():
+            for field, (updated, value) in fields.items():
+                if mean and isinstance(value, Segment):
+                    add_segment(key, field, value, t)
+                value = field_value(updated, value, t, tolerance)
+                if value is not None:
+                    result.setdefault(key, {})[field] = value
+        for key, totals in sums.items():
+            for field, (total, weight) in totals.items():
+                if weight > 0:
+                    result.setdefault(key, {})[field] = total / weight
+        return result
+
+    if step <= 0:
+        mean = False
+        for t, key, values in events:
+            if t >= end:
+                break
+            update(t, key, values)
+            if t >= start:
+                yield t, snapshot(t)
+        return
+
+    t_step = start
+    pending = None
+    events = iter(events)
+    while t_step < end:
+        # as of t includes t, a mean over [t, t + step) excludes t + step
+        limit = t_step + step if mean else t_step
+        while True:
+            if pending is None:
+                pending = next(events, None)
+                if pending is None:
+                    break
+            if pending[0] > limit or (mean and pending[0] == limit):
+                break
+            et, key, values = pending
+            pending = None
+            update(et, key, values)
+        yield t_step, snapshot(limit)
+        sums.clear()
+        t_step += step
+
+# Flattens a snapshot into an output record, adding the household load
+# not explained by the heat pump per phase, in kW. The mains load is taken
+# from the meter, or from the DEFA currents when the meter has no value.
+def derive(t, snapshot):
+    record = { "time": t }
+    heatpump = snapshot.get("heatpump", {}).get("heatpump_kw")
+    meter = snapshot.get("meter", {})
+    defas = [values for key, values in snapshot.items() if key.startswith("defa ")]
+    record["heatpump_kw"] = heatpump
+    for i in range(3):
+        meter_kw = meter.get(METER_PHASES[i])
+        amps = [d[DEFA_PHASES[i]] for d in defas if DEFA_PHASES[i] in d]
+        defa_kw = sum(amps) / len(amps) * VOLTAGE / 1000.0 if amps else None
+        record[f"meter_kw_phase_{i + 1}"] = meter_kw
+        record[f"defa_kw_phase_{i + 1}"] = defa_kw
+        mains_kw = meter_kw if meter_kw is not None else defa_kw
+        if mains_kw is None or heatpump is None:
+            unexplained = None
+        else:
+            unexplained = mains_kw - heatpump * HEATPUMP_PHASES[i]
+        record[f"unexplained_kw_phase_{i + 1}"] = unexplained
+    return record
+
+def merge(sources):
+    return heapq.merge(*sources, key=lambda event: event[0])
+
+def parse_time(s):
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.fromisoformat(s).timestamp()
+
+def usage():
+    print(f"{sys.argv[0]} [-h][-a] -f from [-t to] [-b IVT490 base path] [-s slimmelezer files] [-m mode] [-d DEFA files] [-S serial] [-r step] [-T tolerance]")
+    print(f"\t-f  : start, epoch seconds or ISO date/time (local time)")
+    print(f"\t-t  : end (default now)")
+    print(f"\t-b  : IVT490 base path")
+    print(f"\t-s  : glob of slimmelezer output files, in time order when sorted")
+    print(f"\t-m  : slimmelezer recording mode (-c) of the files: {', '.join(METER_MODES)} (default tick)")
+    print(f"\t-d  : glob of DEFA reading files (JSON lines, mains phase currents), in time order when sorted")
+    print(f"\t-S  : only use the DEFA load balancer with this serial (default all, averaged)")
+    print(f"\t-r  : output step in seconds, 0 for every input event (default 60)")
+    print(f"\t-a  : average each step instead of taking the values as of its start")
+    print(f"\t-T  : seconds after which a value is considered missing (default {TOLERANCE})")
+    print(f"\t-h  : show this help")
+
+def main():
+    from_time = None
+    to_time = time.time()
+    basepath = None
+    meter_glob = None
+    meter_mode = "tick"
+    defa_glob = None
+    serial = None
+    step = 60
+    mean = False
+    tolerance = TOLERANCE
+    optss, args = getopt.getopt(sys.argv[1:], 'haf:t:b:s:m:d:S:r:T:')
+    for o, a in optss:
+        if o == "-f":
+            from_time = parse_time(a)
+        elif o == "-t":
+            to_time = parse_time(a)
+        elif o == "-b":
+            basepath = a
+        elif o == "-s":
+            meter_glob = a
+        elif o == "-m":
+            if a not in METER_MODES:
+                print(f"Unknown recording mode {a}")
+                usage()
+                sys.exit(2)
+            meter_mode = a
+        elif o == "-d":
+            defa_glob = a
+        elif o == "-S":
+            serial = a
+        elif o == "-r":
+            step = float(a)
+        elif o == "-a":
+            mean = True
+        elif o == "-T":
+            tolerance = float(a)
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    if from_time is None:
+        print("Start must be specified")
+        usage()
+        sys.exit(2)
+
+    # start reading early enough for the first output to have values
+    sources = []
+    from_time, start = from_time - tolerance, from_time
+    if basepath is not None:
+        sources.append(heatpump_source(basepath, from_time, to_time))
+    if meter_glob is not None:
+        sources.append(meter_source(sorted(glob.glob(meter_glob)), from_time, to_time, meter_mode))
+    if defa_glob is not None:
+        sources.append(defa_source(sorted(glob.glob(defa_glob)), from_time, to_time, serial))
+
+    for t, snapshot in align(merge(sources), start, to_time, step, mean, tolerance):
+        print(json.dumps(derive(t, snapshot)))
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,11 @@ import time
 import getopt
 import os
 import json
+import metrics
+import queue
 import sys
+import threading
+import swingingdoor
 
 # Program options, defaults
 opts = {
@@ -16,38 +20,153 @@ opts = {
     "list": False,
     "monitorObjectId": "energy_consumed_luxembourg",
     "monitorHangLimit": 20,
+    "staleLimit": 60,
+    "recordMode": "tick",
+    "deviation": 0.01,
+    "devicesFile": None,
+    "entityCache": os.path.expanduser("~/.cache/slimmelezer/entities.json"),
+    "metricsPort": None,
 }
 
-# Shared state updated by the change_callback and read by tick.
-currentState = {}
+# Options that can be set per device in the devices file, defaulting to the
+# command line options.
+DEVICE_OPTS = ["name", "host", "port", "objectIds", "outputFile", "monitorObjectId", "monitorHangLimit", "staleLimit", "recordMode", "deviation"]
 
-def write(fileKey, msg):
-    if fileKey in opts:
+UPDATES = metrics.counter("slimmelezer_state_updates_total", "State updates received", ("device", ))
+RECONNECTS = metrics.counter("slimmelezer_reconnects_total", "Reconnects, by reason", ("device", "reason"))
+CONNECT_FAILURES = metrics.counter("slimmelezer_connect_failures_total", "Failed connection attempts", ("device", ))
+WRITE_SECONDS = metrics.histogram("slimmelezer_write_seconds", "Time to write and flush a batch of queued messages")
+
+# Writes messages from a background thread so that the event loop never
+# blocks on disk I/O. Messages are queued with their time, and the thread
+# writes whatever has queued up in one batch, keeping each file open until
+# its formatted filename changes. "-" is stdout.
+class FileWriter:
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.files = {} # path -> (filename, file)
+
+    def write(self, path, msg):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((path, msg, time.time()))
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            start = time.perf_counter()
+            for item in batch:
+                if item is None:
+                    running = False
+                else:
+                    self.writeItem(*item)
+            for (_, f) in self.files.values():
+                f.flush()
+            WRITE_SECONDS.since(start)
+        for (_, f) in self.files.values():
+            f.close()
+        self.files = {}
+
+    def writeItem(self, path, msg, t):
         # allow date/time formatting in a filename
-        filename = time.strftime(opts[fileKey], time.localtime())
+        filename = time.strftime(path, time.localtime(t))
         if filename == "-":
             print(msg)
-        else:
-            with open(filename, "a") as f:
-                f.write(msg)
-                f.write("\n")
-    else:
-        print(msg)
+            return
+        try:
+            current = self.files.get(path)
+            if current is None or current[0] != filename:
+                if current is not None:
+                    current[1].close()
+                current = self.files[path] = (filename, open(filename, "a"))
+            current[1].write(msg)
+            current[1].write("\n")
+        except OSError as e:
+            current = self.files.pop(path, None)
+            if current is not None:
+                try:
+                    current[1].close()
+                except OSError:
+                    pass # the buffered data is lost either way
+            print(f"Failed to write to {filename}: {e}", file=sys.stderr)
+
+    # Writes everything queued and stops the thread.
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+fileWriter = FileWriter()
+metrics.gauge_func("slimmelezer_write_queue", "Messages queued for writing", lambda: fileWriter.queue.qsize())
 
 def log(msg):
-    write("logFile", msg)
+    fileWriter.write(opts["logFile"], msg)
+
+# An ESPHome device we collect from, with its own options, state and output.
+class Device:
+    def __init__(self, deviceOpts):
+        self.opts = deviceOpts
+        self.name = deviceOpts.get("name") or deviceOpts["host"]
+        # state updated by the change_callback and read by tick
+        self.currentState = {}
+        # per object ID compressors, when recording changes instead of ticking
+        self.compressors = {}
+
+    def log(self, msg):
+        log(f"[{self.name}] {msg}")
+
+    def write(self, msg):
+        fileWriter.write(self.opts["outputFile"], msg)
+
+    # Periodically called to write the current state as JSON. Nothing is
+    # written while disconnected, see forget.
+    def tick(self):
+        if not self.currentState:
+            return
+        state = self.currentState.copy()
+        state["seconds"] = time.time()
+        stateJson = json.dumps(state)
+        self.write(stateJson)
+
+    # Records a state change through the object ID's compressor, writing the
+    # points it keeps in the same format as tick but with a single object ID.
+    def record(self, objectId, value, unit):
+        compressor = self.compressors.get(objectId)
+        if compressor is None:
+            compressor = self.compressors[objectId] = swingingdoor.COMPRESSORS[self.opts["recordMode"]](self.opts["deviation"])
+        self.writePoints(objectId, unit, compressor.add(time.time(), float(value)))
 
-# Periodically called to write the current state as JSON
-def tick():
-    state = currentState.copy()
-    state["seconds"] = time.time()
-    stateJson = json.dumps(state)
-    write("outputFile", stateJson)
+    def writePoints(self, objectId, unit, points):
+        for (t, value) in points:
+            self.write(json.dumps({ objectId: { "value": value, "unit": unit }, "seconds": t }))
+
+    # Writes the last point of each series, if it hasn't been recorded yet.
+    def flushCompressors(self):
+        for objectId, compressor in self.compressors.items():
+            self.writePoints(objectId, self.currentState.get(objectId, {}).get("unit"), compressor.flush())
+
+    # Drops the state when the connection is lost, so that ticks don't repeat
+    # old values as new readings and compressed series don't interpolate
+    # across the outage.
+    def forget(self):
+        self.flushCompressors()
+        self.compressors.clear()
+        self.currentState.clear()
 
 # Helper function that calls the given callback on regular intervals.
 def setInterval(loop, callback, interval):
     timer = None
     def wrapper():
+        nonlocal timer
         callback()
         timer = loop.call_later(interval, wrapper)
     timer = loop.call_later(interval, wrapper)
@@ -68,75 +187,276 @@ async def createKeyLookup(api):
                     d[s.key] = (s.object_id, s.unit_of_measurement)
     return d
 
+# Key lookups from earlier connections, stored on disk so that state
+# changes can be subscribed to right after connecting instead of after
+# listing all entities. Lookups are keyed on the device's name, MAC address
+# and firmware build, so a reflashed device gets a new one.
+class EntityCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+
+    def load(self):
+        if self.entries is None:
+            self.entries = {}
+            if self.path is not None:
+                try:
+                    with open(self.path) as f:
+                        self.entries = json.load(f)
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError) as e:
+                    log(f"Not using entity cache {self.path}: {e}")
+        return self.entries
+
+    def get(self, cacheKey):
+        entry = self.load().get(cacheKey)
+        if entry is None:
+            return None
+        return { key: (objectId, unit) for (key, objectId, unit) in entry }
+
+    def put(self, cacheKey, lookup):
+        self.load()[cacheKey] = [[key, objectId, unit] for (key, (objectId, unit)) in lookup.items()]
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log(f"Failed to write entity cache {self.path}: {e}")
+
+entityCache = EntityCache(None)
+
+def entityCacheKey(info):
+    return f"{info.name}/{info.mac_address}/{info.esphome_version}/{info.compilation_time}"
+
 def dumpObjectIds(lookup):
     print("Available object IDs:")
     for objId in lookup.values():
         print(f"- {objId}")
 
-async def start(eventloop, outP):
-    log(f"Establishing a connection to {opts['host']}:{opts['port']}")
-    api = aioesphomeapi.APIClient(opts["host"], opts["port"], "")
-    await api.connect(login=True)
+# Seconds to wait before reconnecting, doubled after each failed attempt.
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
 
-    log("Mapping keys to object IDs")
-    keyLookup = await createKeyLookup(api)
+# Detects a hung connection: the monitored object ID repeating the same value
+# monitorHangLimit times in a row, or a watched object ID not updated for
+# staleLimit seconds. Both checks are O(1) per state update.
+class Watchdog:
+    def __init__(self, monitorObjectId, objectIds, hangLimit, staleLimit):
+        self.monitorObjectId = monitorObjectId
+        self.watched = set(objectIds) | { monitorObjectId }
+        self.hangLimit = hangLimit
+        self.staleLimit = staleLimit
+        self.reset()
 
-    if opts["list"]:
-        dumpObjectIds(keyLookup)
-        eventloop.stop()
-        return
+    def reset(self):
+        self.lastValue = None
+        self.sameCount = 0
+        self.lastUpdate = {}
+
+    # Returns True if this update means the connection has hung.
+    def update(self, objectId, value):
+        if objectId in self.watched:
+            self.lastUpdate[objectId] = time.monotonic()
+        if objectId != self.monitorObjectId:
+            return False
+        if value == self.lastValue:
+            self.sameCount += 1
+        else:
+            self.lastValue = value
+            self.sameCount = 1
+        return self.sameCount >= self.hangLimit
+
+    # Called once subscribed, so that object IDs the device has are stale
+    # after staleLimit seconds even if they never get an update.
+    def subscribed(self, objectIds):
+        now = time.monotonic()
+        for objectId in self.watched & set(objectIds):
+            self.lastUpdate.setdefault(objectId, now)
+
+    # Object IDs not updated for staleLimit seconds since subscribing.
+    def stale(self):
+        now = time.monotonic()
+        return [objectId for (objectId, t) in self.lastUpdate.items() if now - t > self.staleLimit]
 
-    monitorObjectId = opts["monitorObjectId"]
-    monitorHangLimit = opts["monitorHangLimit"]
-    monitorValues = []
-
-    log(f"Monitoring {monitorObjectId} to check for hang; {monitorHangLimit} consecutive equal values will trigger a restart.")
-
-    def check_hang(value):
-        monitorValues.append(value)
-        while len(monitorValues) > monitorHangLimit:
-            monitorValues.pop(0)
-        if len(monitorValues) == monitorHangLimit:
-            allSame = len(set(monitorValues)) == 1
-            if allSame:
-                log(f"Hang detected! The last {monitorHangLimit} values of {monitorObjectId} are the same. Exiting with non-zero exit status to trigger systemd restart.")
-                #api.disconnect() # cannot await here, not in async context
-                outP["exitCode"] = 1
-                eventloop.stop()
+# Keeps a connection to an ESPHome device, reconnecting with exponential
+# backoff when it's lost or the watchdog detects a hang.
+class Connection:
+    def __init__(self, device):
+        self.device = device
+        self.api = None
+        self.keyLookup = {}
+        self.refreshTask = None
+        self.lost = asyncio.Event()
+        o = device.opts
+        self.watchdog = Watchdog(o["monitorObjectId"], o["objectIds"], o["monitorHangLimit"], o["staleLimit"])
+        self.updates = UPDATES.labels(device.name)
+
+    def reconnect(self, reason, msg):
+        if not self.lost.is_set():
+            RECONNECTS.labels(self.device.name, reason).inc()
+            self.device.log(f"{msg} Reconnecting.")
+            self.lost.set()
+            self.device.forget()
+
+    async def onStop(self, *args):
+        self.reconnect("disconnect", "Disconnected!")
+
+    def checkStale(self):
+        stale = self.watchdog.stale()
+        if stale:
+            self.reconnect("stale", f"No updates of {', '.join(stale)} for {self.watchdog.staleLimit} seconds!")
+
+    def change_callback(self, state):
+        self.updates.inc()
+        if state.missing_state or self.lost.is_set():
+            return
+
+        if state.key in self.keyLookup:
+            (objectId, unit) = self.keyLookup[state.key]
+
+            if self.watchdog.update(objectId, state.state):
+                self.reconnect("hang", f"Hang detected! The last {self.watchdog.hangLimit} values of {objectId} are the same.")
+
+            device = self.device
+            if objectId in device.opts["objectIds"]:
+                device.currentState[objectId] = { "value": state.state, "unit": unit }
+                if device.opts["recordMode"] != "tick":
+                    device.record(objectId, state.state, unit)
+
+    async def connect(self, useCache=True):
+        o = self.device.opts
+        self.device.log(f"Establishing a connection to {o['host']}:{o['port']}")
+        self.api = aioesphomeapi.APIClient(o["host"], o["port"], "")
+        await self.api.connect(on_stop=self.onStop, login=True)
+
+        if useCache:
+            cacheKey = entityCacheKey(await self.api.device_info())
+            lookup = entityCache.get(cacheKey)
+            if lookup is not None:
+                self.device.log("Using cached object IDs, refreshing in the background")
+                self.keyLookup = lookup
+                self.refreshTask = asyncio.ensure_future(self.refreshKeyLookup(cacheKey))
                 return
 
-    # TODO: If state doesn't change for a while, disconnect and reconnect!
-    def change_callback(state):
-        if state.missing_state:
+        self.device.log("Mapping keys to object IDs")
+        self.keyLookup = await createKeyLookup(self.api)
+        if useCache:
+            entityCache.put(cacheKey, self.keyLookup)
+
+    # Lists the entities again after connecting with a cached lookup, in
+    # case they changed without the firmware build changing.
+    async def refreshKeyLookup(self, cacheKey):
+        try:
+            lookup = await createKeyLookup(self.api)
+        except (aioesphomeapi.APIConnectionError, OSError, asyncio.TimeoutError) as e:
+            self.device.log(f"Failed to refresh object IDs: {e}")
             return
+        if lookup != self.keyLookup:
+            self.device.log("Object IDs changed, updating the entity cache")
+            self.keyLookup = lookup
+            entityCache.put(cacheKey, lookup)
+
+    async def disconnect(self):
+        if self.refreshTask is not None:
+            self.refreshTask.cancel()
+            self.refreshTask = None
+        api = self.api
+        self.api = None
+        if api is not None:
+            try:
+                await api.disconnect()
+            except Exception:
+                pass # already gone
 
-        if state.key in keyLookup:
-            (objectId, unit) = keyLookup[state.key]
+    async def run(self):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            self.lost.clear()
+            self.watchdog.reset()
+            try:
+                await self.connect()
+                self.device.log("Subscribing to state changes")
+                await self.api.subscribe_states(self.change_callback)
+                self.watchdog.subscribed(objectId for (objectId, _) in self.keyLookup.values())
+                delay = RECONNECT_MIN_DELAY
+                await self.lost.wait()
+            except (aioesphomeapi.APIConnectionError, OSError, asyncio.TimeoutError) as e:
+                CONNECT_FAILURES.labels(self.device.name).inc()
+                self.device.log(f"Connection failed: {e}")
+                self.device.forget()
+            await self.disconnect()
+            self.device.log(f"Reconnecting in {delay} seconds")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
 
-            if objectId == monitorObjectId:
-                check_hang(state.state)
+async def listObjectIds(devices):
+    for device in devices:
+        connection = Connection(device)
+        await connection.connect(useCache=False)
+        print(f"{device.name}:")
+        dumpObjectIds(connection.keyLookup)
+        await connection.disconnect()
 
-            if objectId in opts["objectIds"]:
-                currentState[objectId] = { "value": state.state, "unit": unit }
+async def start(eventloop, device):
+    connection = Connection(device)
+    o = device.opts
+    device.log(f"Monitoring {o['monitorObjectId']} to check for hang; {o['monitorHangLimit']} consecutive equal values, or no updates for {o['staleLimit']} seconds, will trigger a reconnect.")
+    setInterval(eventloop, connection.checkStale, 5)
+    await connection.run()
 
-    log("Subscribing to state changes")
-    await api.subscribe_states(change_callback)
+# Reads the devices file, a JSON list of objects with any of DEVICE_OPTS.
+# Options not given for a device are taken from the command line, except
+# that no two devices may share an outputFile.
+def readDevices():
+    if opts["devicesFile"] is None:
+        return [Device({ k: opts[k] for k in DEVICE_OPTS if k in opts })]
+    with open(opts["devicesFile"]) as f:
+        devices = []
+        for d in json.load(f):
+            unknown = set(d) - set(DEVICE_OPTS)
+            if unknown:
+                raise ValueError(f"Unknown device options {', '.join(sorted(unknown))}")
+            deviceOpts = { k: opts[k] for k in DEVICE_OPTS if k in opts }
+            deviceOpts.update(d)
+            if "host" not in deviceOpts:
+                raise ValueError("Host must be specified for every device")
+            if "outputFile" in d:
+                deviceOpts["outputFile"] = os.path.abspath(d["outputFile"])
+            devices.append(Device(deviceOpts))
+    # records carry no device name, so each device needs a file of its own
+    outputFiles = [device.opts["outputFile"] for device in devices]
+    if len(set(outputFiles)) < len(outputFiles):
+        raise ValueError("Every device must have its own outputFile")
+    return devices
 
 def usage():
     ids = str.join(",", opts["objectIds"])
-    print(f"{sys.argv[0]} [-h][-L] [-l log file] [-o output file] <-H host name> [-p port] [-i object IDs]")
+    print(f"{sys.argv[0]} [-h][-L] [-l log file] [-o output file] <-H host name | -D devices file> [-p port] [-i object IDs]")
     print(f"\t-l  : path to file that will receive log messages (default {opts['logFile']})")
     print(f"\t-o  : path to file that will receive JSON output (default {opts['outputFile']})")
-    print(f"\t-H  : ESPHOME host name, required")
+    print(f"\t-H  : ESPHOME host name, required unless -D is given")
+    print(f"\t-D  : JSON file with a list of devices to collect from, e.g. [{{\"host\": \"a\", \"outputFile\": \"a-%Y%m%d.log\"}}, ...];")
+    print(f"\t      each may set {', '.join(DEVICE_OPTS)}, defaulting to the options given here;")
+    print(f"\t      outputFile must differ between devices")
     print(f"\t-p  : ESPHOME port (default {opts['port']})")
     print(f"\t-i  : comma-separated list of object IDs (default {ids})")
     print(f"\t-m  : object ID to monitor for hang (default {opts['monitorObjectId']})")
     print(f"\t-M  : monitor hang limit (default {opts['monitorHangLimit']})")
+    print(f"\t-s  : seconds without updates of an object ID before reconnecting (default {opts['staleLimit']})")
+    print(f"\t-c  : recording mode: tick (all object IDs every 10 s), deadband or swingingdoor (changes, compressed per object ID) (default {opts['recordMode']})")
+    print(f"\t-d  : deviation for the deadband/swingingdoor modes, in the unit of each object ID (default {opts['deviation']})")
+    print(f"\t-K  : entity cache file, or - to disable (default {opts['entityCache']})")
+    print(f"\t-P  : serve metrics on http://localhost:<port>/metrics")
     print(f"\t-L  : list object IDs and exit")
     print(f"\t-h  : show this help")
 
 def readOpts():
-    optss, args = getopt.getopt(sys.argv[1:], 'H:p:l:hi:o:Lm:M:')
+    optss, args = getopt.getopt(sys.argv[1:], 'H:p:l:hi:o:Lm:M:c:d:s:D:K:P:')
     for o, a in optss:
         if o == "-i":
             opts["objectIds"] = a.split(",")
@@ -146,51 +466,100 @@ def readOpts():
             opts["port"] = int(a)
         elif o == "-H":
             opts["host"] = a
+        elif o == "-D":
+            opts["devicesFile"] = a
         elif o == "-l":
             opts["logFile"] = os.path.abspath(a)
+        elif o == "-K":
+            opts["entityCache"] = None if a == "-" else os.path.abspath(a)
+        elif o == "-P":
+            opts["metricsPort"] = int(a)
         elif o == "-L":
             opts["list"] = True
         elif o == "-m":
             opts["monitorObjectId"] = a
         elif o == "-M":
             opts["monitorHangLimit"] = int(a)
+        elif o == "-s":
+            opts["staleLimit"] = float(a)
+        elif o == "-c":
+            opts["recordMode"] = a
+        elif o == "-d":
+            opts["deviation"] = float(a)
         elif o == "-h":
             usage()
             sys.exit(2)
 
-    if "host" not in opts:
+    if "host" not in opts and opts["devicesFile"] is None:
         print("Host must be specified")
         usage()
         sys.exit(2)
 
+    try:
+        devices = readDevices()
+    except (OSError, ValueError) as e:
+        print(f"Failed to read devices: {e}")
+        sys.exit(2)
+
+    for device in devices:
+        recordMode = device.opts["recordMode"]
+        if recordMode != "tick" and recordMode not in swingingdoor.COMPRESSORS:
+            print(f"Unknown recording mode {recordMode} for {device.name}")
+            usage()
+            sys.exit(2)
+
+    return devices
+
 def main():
-    readOpts()
+    global entityCache
+    devices = readOpts()
+    entityCache = EntityCache(opts["entityCache"])
 
     log("Getting event loop")
     loop = asyncio.get_event_loop()
 
-    log("Starting timer")
-    cancelTimer = setInterval(loop, tick, 10)
+    if opts["list"]:
+        loop.run_until_complete(listObjectIds(devices))
+        loop.close()
+        fileWriter.close()
+        return
+
+    tickDevices = [device for device in devices if device.opts["recordMode"] == "tick"]
+    for device in devices:
+        if device not in tickDevices:
+            device.log(f"Recording changes using {device.opts['recordMode']} with deviation {device.opts['deviation']}")
+
+    def tick():
+        for device in tickDevices:
+            device.tick()
+
+    if tickDevices:
+        log("Starting timer")
+        cancelTimer = setInterval(loop, tick, 10)
+    else:
+        cancelTimer = lambda: None
+
+    if opts["metricsPort"]:
+        log(f"Serving metrics on port {opts['metricsPort']}")
+        metrics.serve(opts["metricsPort"])
+        metrics.watch_loop_lag(loop, name="slimmelezer_event_loop_lag_seconds")
 
-    # A plain global variable didn't work.
-    outP = { "exitCode": 0 }
     try:
-        log("Starting up")
-        asyncio.ensure_future(start(loop, outP))
+        log(f"Starting up, collecting from {len(devices)} device(s)")
+        for device in devices:
+            asyncio.ensure_future(start(loop, device))
         loop.run_forever()
-        pass
     except KeyboardInterrupt:
         pass
     finally:
         log("Closing down")
         cancelTimer()
+        for device in devices:
+            device.flushCompressors()
         #loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
         log("Closed!")
-
-        exitCode = outP["exitCode"]
-        if exitCode > 0:
-            sys.exit(exitCode)
+        fileWriter.close()
 
 if __name__ == "__main__":
     main()
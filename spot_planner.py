@@ -0,0 +1,268 @@
+import getopt
+import json
+import sys
+import time
+import urllib.request
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+import spot_price
+
+# Plans electricity use by the hourly spot prices of today and, once
+# published (early afternoon), tomorrow: when to charge the car through the
+# DEFA charger, contiguously or in the cheapest separate hours, and which
+# hours are cheapest for heating hot water with the IVT490. Prices include
+# VAT, in SEK/kWh. The charging current is capped per phase, and with -d
+# also by what the household load measured by the DEFA load balancer leaves
+# of the main fuse.
+
+VOLTAGE = 230
+PHASES = 3
+# Car plugged in at ARRIVAL_HOUR and needed again at DEPARTURE_HOUR the next day
+ARRIVAL_HOUR = 18
+DEPARTURE_HOUR = 7
+# Main fuse per phase in A, and how far back defa_lb_server's readings are
+# looked at for the household load. Of the readings from while the car is
+# away, this percentile is taken as the household's peak, leaving out short
+# spikes the load balancer handles anyway.
+FUSE_AMPS = 20
+DEFA_WINDOW = 86400
+HOUSEHOLD_PERCENTILE = 99
+DEFA_PHASES = ("phase1_amps", "phase2_amps", "phase3_amps")
+
+# Returns [(hour start, price, hours)] for the hours from start until end
+# (epoch seconds), stopping at the first hour without a price, e.g.
+# tomorrow's before they're published. hours is the part of the hour
+# within the range, less than 1 for the current hour when it's under way.
+def price_series(prices, start, end):
+    series = []
+    t = spot_price.hour_start(start)
+    while t < end:
+        try:
+            price = prices.hour_price(t)
+        except (KeyError, OSError, ValueError):
+            break
+        series.append((t, price, (min(t + 3600, end) - max(t, start)) / 3600.0))
+        t += 3600
+    return series
+
+def max_charging_kw(amps, phases=PHASES, voltage=VOLTAGE):
+    return amps * phases * voltage / 1000.0
+
+# The current per phase left for charging: the main fuse minus the
+# household load. The DEFA load balancer measures the mains current, the
+# car's charging included, so only the readings from while the car is away
+# (departure until arrival) in defa_lb_server's /history are used.
+def defa_headroom(url, fuse_amps=FUSE_AMPS, departure=DEPARTURE_HOUR, arrival=ARRIVAL_HOUR, window=DEFA_WINDOW):
+    with urllib.request.urlopen(f"{url}/history?window={window:.0f}", timeout=30) as response:
+        history = json.loads(response.read())
+    peaks = []
+    for readings in history.values():
+        away = [i for i, t in enumerate(readings["time"]) if departure <= datetime.fromtimestamp(t).hour < arrival]
+        for phase in DEFA_PHASES:
+            values = sorted(readings[phase][i] for i in away)
+            if values:
+                peaks.append(values[round(HOUSEHOLD_PERCENTILE / 100.0 * (len(values) - 1))])
+    if not peaks:
+        raise ValueError(f"no readings from between {departure}:00 and {arrival}:00 in the last {window} seconds")
+    return max(0.0, fuse_amps - max(peaks))
+
+# Fills energy_kwh into the hours at indexes, cheapest first and at most
+# capacity kWh each. Returns ({ index: kWh }, cost), or None if it doesn't fit.
+def fill_cheapest(values, capacity, indexes, energy_kwh):
+    kwh = {}
+    cost = 0.0
+    for i in sorted(indexes, key=values.__getitem__):
+        if energy_kwh <= 1e-9:
+            break
+        kwh[i] = min(capacity[i], energy_kwh)
+        cost += values[i] * kwh[i]
+        energy_kwh -= kwh[i]
+    return (kwh, cost) if energy_kwh <= 1e-9 else None
+
+# The run of consecutive hours taking energy_kwh at the lowest cost. The
+# shortest run from each start is found with prefix sums of the capacities,
+# and filled cheapest first.
+def cheapest_window(values, capacity, energy_kwh):
+    prefix = list(accumulate(capacity, initial=0.0))
+    best = None
+    end = 0
+    for start in range(len(values)):
+        end = max(end, start + 1)
+        while end <= len(values) and prefix[end] - prefix[start] < energy_kwh - 1e-9:
+            end += 1
+        if end > len(values):
+            break
+        result = fill_cheapest(values, capacity, range(start, end), energy_kwh)
+        if best is None or result[1] < best[1]:
+            best = result
+    return best
+
+# Plans charging energy_kwh at up to max_kw within the series, either in
+# one contiguous run or in the cheapest hours, the last hour of the plan by
+# price taking what's left. Returns ([(hour start, kWh)], cost) in time
+# order, or None if the energy doesn't fit.
+def plan_charging(series, energy_kwh, max_kw, contiguous=False):
+    if energy_kwh <= 0:
+        return [], 0.0
+    values = [price for _, price, _ in series]
+    capacity = [max_kw * hours for _, _, hours in series]
+    if contiguous:
+        result = cheapest_window(values, capacity, energy_kwh)
+    else:
+        result = fill_cheapest(values, capacity, range(len(values)), energy_kwh)
+    if result is None:
+        return None
+    kwh, cost = result
+    return [(series[i][0], kwh[i]) for i in sorted(kwh)], cost
+
+# Charging as soon as the car is plugged in, to compare plans against.
+def immediate_charging(series, energy_kwh, max_kw):
+    plan = []
+    cost = 0.0
+    for t, price, hours in series:
+        if energy_kwh <= 0:
+            break
+        kwh = min(max_kw * hours, energy_kwh)
+        plan.append((t, kwh))
+        cost += price * kwh
+        energy_kwh -= kwh
+    return (plan, cost) if energy_kwh <= 1e-9 else None
+
+# Ranks the hours by price for hot water: [(hour start, price, rank)] in
+# time order, rank 0 being the cheapest.
+def rank_hours(series):
+    order = sorted(range(len(series)), key=lambda i: series[i][1])
+    ranks = [0] * len(series)
+    for rank, i in enumerate(order):
+        ranks[i] = rank
+    return [(t, price, ranks[i]) for i, (t, price, _) in enumerate(series)]
+
+# The hours the car is plugged in, from ARRIVAL_HOUR on day to DEPARTURE_HOUR the next day.
+def overnight(day, arrival=ARRIVAL_HOUR, departure=DEPARTURE_HOUR):
+    start = datetime(day.year, day.month, day.day, arrival).timestamp()
+    next_day = day + timedelta(days=1)
+    end = datetime(next_day.year, next_day.month, next_day.day, departure).timestamp()
+    return start, end
+
+# Plans every night from first to last day and sums the costs of charging
+# immediately, in the cheapest window and in the cheapest hours. Nights
+# without prices are skipped.
+def backtest(prices, first, last, energy_kwh, max_kw, arrival=ARRIVAL_HOUR, departure=DEPARTURE_HOUR):
+    totals = { "nights": 0, "immediate": 0.0, "window": 0.0, "hours": 0.0 }
+    day = first
+    while day <= last:
+        series = price_series(prices, *overnight(day, arrival, departure))
+        immediate = immediate_charging(series, energy_kwh, max_kw)
+        window = plan_charging(series, energy_kwh, max_kw, contiguous=True)
+        hours = plan_charging(series, energy_kwh, max_kw)
+        if immediate is not None and window is not None and hours is not None:
+            totals["nights"] += 1
+            totals["immediate"] += immediate[1]
+            totals["window"] += window[1]
+            totals["hours"] += hours[1]
+        # keep memory flat over years of days
+        prices.days.pop(day - timedelta(days=1), None)
+        day += timedelta(days=1)
+    return totals
+
+def print_plan(name, result):
+    if result is None:
+        print(f"{name}: not enough hours")
+        return
+    plan, cost = result
+    print(f"{name}: {cost:.2f} SEK")
+    for t, kwh in plan:
+        print(f"  {datetime.fromtimestamp(t):%Y-%m-%d %H:00} {kwh:.2f} kWh")
+
+def usage():
+    print(f"{sys.argv[0]} [-h][-c] [-s source] [-e kWh] [-a amps] [-d defa_lb_server URL] [-f fuse amps] [-p phases] [-u until hour] [-w hot water hours] [-b first day:last day]")
+    print(f"\t-s  : spot price API base URL, local directory laid out like it, or a JSON file (default {spot_price.SOURCE})")
+    print(f"\t-e  : energy to charge in kWh (default 20)")
+    print(f"\t-a  : charging current cap per phase in A (default 16)")
+    print(f"\t-d  : defa_lb_server base URL, e.g. http://localhost:8000; caps the current at the main fuse minus")
+    print(f"\t      the household load, the mains current measured while the car is away (until hour -u")
+    print(f"\t      to ARRIVAL_HOUR ({ARRIVAL_HOUR})) in the last {DEFA_WINDOW} seconds, p{HOUSEHOLD_PERCENTILE}")
+    print(f"\t-f  : main fuse per phase in A, with -d (default {FUSE_AMPS})")
+    print(f"\t-p  : number of phases charged on (default {PHASES})")
+    print(f"\t-u  : hour the car must be charged by (default {DEPARTURE_HOUR})")
+    print(f"\t-c  : charge in one contiguous window instead of the cheapest hours")
+    print(f"\t-w  : number of cheapest hours to mark for hot water (default 3)")
+    print(f"\t-b  : backtest every night from ARRIVAL_HOUR ({ARRIVAL_HOUR}) between the days, e.g. 2023-01-01:2024-12-31")
+    print(f"\t-h  : show this help")
+
+def main():
+    prices = spot_price.SpotPrices()
+    energy = 20.0
+    amps = 16.0
+    defa_url = None
+    fuse = FUSE_AMPS
+    phases = PHASES
+    departure = DEPARTURE_HOUR
+    contiguous = False
+    hot_water_hours = 3
+    backtest_days = None
+    optss, args = getopt.getopt(sys.argv[1:], 'hcs:e:a:d:f:p:u:w:b:')
+    for o, a in optss:
+        if o == "-s":
+            prices.source = a
+        elif o == "-e":
+            energy = float(a)
+        elif o == "-a":
+            amps = float(a)
+        elif o == "-d":
+            defa_url = a.rstrip("/")
+        elif o == "-f":
+            fuse = float(a)
+        elif o == "-p":
+            phases = int(a)
+        elif o == "-u":
+            departure = int(a)
+        elif o == "-c":
+            contiguous = True
+        elif o == "-w":
+            hot_water_hours = int(a)
+        elif o == "-b":
+            backtest_days = [date.fromisoformat(d) for d in a.split(":")]
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    if defa_url is not None:
+        try:
+            headroom = defa_headroom(defa_url, fuse, departure)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Failed to get the household load from {defa_url}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{headroom:.1f} A per phase left by the household load")
+        amps = min(amps, headroom)
+    max_kw = max_charging_kw(amps, phases)
+    if backtest_days is not None:
+        start = time.perf_counter()
+        totals = backtest(prices, backtest_days[0], backtest_days[1], energy, max_kw, departure=departure)
+        seconds = time.perf_counter() - start
+        nights = totals["nights"]
+        print(f"{nights} nights in {seconds:.2f} s, charging {energy} kWh at up to {max_kw:.1f} kW")
+        for name in ("immediate", "window", "hours"):
+            total = totals[name]
+            print(f"{name:10} {total:10.2f} SEK, {total / nights if nights else 0:.2f} SEK/night")
+        return
+
+    now = time.time()
+    today = date.today()
+    until = datetime(today.year, today.month, today.day, departure)
+    if until.timestamp() <= now:
+        until += timedelta(days=1)
+    series = price_series(prices, now, until.timestamp())
+    print(f"Charging {energy} kWh at up to {max_kw:.1f} kW by {until:%Y-%m-%d %H:00}")
+    print_plan("Contiguous" if contiguous else "Cheapest hours", plan_charging(series, energy, max_kw, contiguous))
+    print_plan("Immediately", immediate_charging(series, energy, max_kw))
+
+    # hot water for the rest of today and, if published, tomorrow
+    day_after = today + timedelta(days=2)
+    ranked = rank_hours(price_series(prices, now, datetime(day_after.year, day_after.month, day_after.day).timestamp()))
+    print(f"Hot water, hours by price ({hot_water_hours} cheapest marked):")
+    for t, price, rank in ranked:
+        print(f"  {datetime.fromtimestamp(t):%Y-%m-%d %H:00} {price:.3f} #{rank + 1}{' *' if rank < hot_water_hours else ''}")
+
+if __name__ == "__main__":
+    main()
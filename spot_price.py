@@ -0,0 +1,189 @@
+import getopt
+import glob
+import json
+import os
+import sys
+import time
+import urllib.request
+from datetime import date, datetime, timedelta
+
+# Spot prices from elprisetjustnu.se, e.g.
+# https://www.elprisetjustnu.se/api/v1/prices/2024/07-01_SE4.json
+# Each day is fetched once and kept in the cache directory, under the same
+# names spot_price_colors.sh used, and in memory while running.
+SOURCE = "https://www.elprisetjustnu.se/api/v1/prices"
+AREA = "SE4"
+CACHE_DIR = "/tmp"
+# Cached days older than this are removed
+MAX_CACHE_DAYS = 7
+
+VAT = 1.25
+# Colors for prices including VAT, in SEK/kWh, up to and including each limit
+THRESHOLDS = [(0.4, "green"), (0.75, "yellow"), (1.0, "orange")]
+ABOVE_COLOR = "red"
+
+def price_to_color(price, thresholds=THRESHOLDS, above=ABOVE_COLOR):
+    for limit, color in thresholds:
+        if price <= limit:
+            return color
+    return above
+
+# Parses "0.4:green,0.75:yellow,1:orange"
+def parse_thresholds(s):
+    thresholds = []
+    for part in s.split(","):
+        limit, color = part.split(":")
+        thresholds.append((float(limit), color))
+    return sorted(thresholds)
+
+def hour_start(t):
+    return int(t // 3600 * 3600)
+
+class SpotPrices:
+    # source is the API base URL, a local directory laid out like it
+    # (<source>/YYYY/MM-DD_<area>.json), or a single JSON file used for every day.
+    def __init__(self, area=AREA, source=SOURCE, cache_dir=CACHE_DIR, vat=VAT, max_cache_days=MAX_CACHE_DAYS):
+        self.area = area
+        self.source = source
+        self.cache_dir = cache_dir
+        self.vat = vat
+        self.max_cache_days = max_cache_days
+        self.days = {} # date -> { hour start (epoch seconds): SEK/kWh without VAT }
+        self.evicted = False
+
+    def cache_path(self, day):
+        return f"{self.cache_dir}/spot-prices-{day:%Y%m%d}.json"
+
+    def read_source(self, day):
+        if os.path.isfile(self.source):
+            path = self.source
+        elif os.path.isdir(self.source):
+            path = f"{self.source}/{day:%Y}/{day:%m-%d}_{self.area}.json"
+        else:
+            url = f"{self.source}/{day:%Y}/{day:%m-%d}_{self.area}.json"
+            with urllib.request.urlopen(url, timeout=30) as response:
+                return response.read()
+        with open(path, "rb") as f:
+            return f.read()
+
+    def load(self, day):
+        network = not os.path.exists(self.source)
+        raw = None
+        if network and self.cache_dir is not None:
+            try:
+                with open(self.cache_path(day), "rb") as f:
+                    raw = f.read()
+            except FileNotFoundError:
+                pass
+        if raw is None:
+            raw = self.read_source(day)
+            if network and self.cache_dir is not None:
+                self.evict()
+                tmp = self.cache_path(day) + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(raw)
+                os.replace(tmp, self.cache_path(day))
+        # a single file stands in for every day, hour by hour
+        return parse_day(json.loads(raw), day if os.path.isfile(self.source) else None)
+
+    # Removes cached days older than max_cache_days, once per run.
+    def evict(self):
+        if self.evicted:
+            return
+        self.evicted = True
+        oldest = date.today() - timedelta(days=self.max_cache_days)
+        for path in glob.glob(f"{self.cache_dir}/spot-prices-*.json"):
+            name = os.path.basename(path)[len("spot-prices-"):-len(".json")]
+            try:
+                day = datetime.strptime(name, "%Y%m%d").date()
+            except ValueError:
+                continue
+            if day < oldest:
+                os.remove(path)
+        for day in [d for d in self.days if d < oldest]:
+            del self.days[day]
+
+    def day_prices(self, day):
+        prices = self.days.get(day)
+        if prices is None:
+            prices = self.days[day] = self.load(day)
+        return prices
+
+    # Price including VAT for the hour starting at epoch seconds t.
+    def hour_price(self, t):
+        t = hour_start(t)
+        return self.day_prices(datetime.fromtimestamp(t).date())[t] * self.vat
+
+    # Returns [(hour start, price including VAT, color)] for the current
+    # hour and the count - 1 following.
+    def hours(self, count, now=None, thresholds=THRESHOLDS):
+        start = hour_start(time.time() if now is None else now)
+        result = []
+        for i in range(count):
+            t = start + i * 3600
+            price = self.hour_price(t)
+            result.append((datetime.fromtimestamp(t), price, price_to_color(price, thresholds)))
+        return result
+
+# Maps the start of each hour (epoch seconds) to its price, averaging
+# when the day is given in quarter hours. With on_day, the prices are moved
+# to the same hours of that day, whatever day the entries are for.
+def parse_day(entries, on_day=None):
+    sums = {}
+    for e in entries:
+        start = datetime.fromisoformat(e["time_start"])
+        if on_day is None:
+            t = hour_start(start.timestamp())
+        else:
+            t = hour_start(datetime.combine(on_day, datetime.min.time()).replace(hour=start.hour).timestamp())
+        s = sums.setdefault(t, [0.0, 0])
+        s[0] += e["SEK_per_kWh"]
+        s[1] += 1
+    return { t: total / n for t, (total, n) in sums.items() }
+
+def usage():
+    limits = ",".join(f"{limit}:{color}" for limit, color in THRESHOLDS)
+    print(f"{sys.argv[0]} [-h][-c] [-n hours] [-a area] [-s source] [-C cache dir] [-v VAT factor] [-t thresholds]")
+    print(f"\t-n  : number of hours from now (default 3)")
+    print(f"\t-c  : only print the colors, separated by spaces")
+    print(f"\t-a  : price area (default {AREA})")
+    print(f"\t-s  : API base URL, local directory laid out like it, or a JSON file (default {SOURCE})")
+    print(f"\t-C  : cache directory (default {CACHE_DIR})")
+    print(f"\t-v  : VAT factor (default {VAT})")
+    print(f"\t-t  : color thresholds, prices above the last are {ABOVE_COLOR} (default {limits})")
+    print(f"\t-h  : show this help")
+
+def main():
+    count = 3
+    colors_only = False
+    thresholds = THRESHOLDS
+    prices = SpotPrices()
+    optss, args = getopt.getopt(sys.argv[1:], 'hcn:a:s:C:v:t:')
+    for o, a in optss:
+        if o == "-n":
+            count = int(a)
+        elif o == "-c":
+            colors_only = True
+        elif o == "-a":
+            prices.area = a
+        elif o == "-s":
+            prices.source = a
+        elif o == "-C":
+            prices.cache_dir = a
+        elif o == "-v":
+            prices.vat = float(a)
+        elif o == "-t":
+            thresholds = parse_thresholds(a)
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    hours = prices.hours(count, thresholds=thresholds)
+    if colors_only:
+        print(" ".join(color for _, _, color in hours))
+    else:
+        for t, price, color in hours:
+            print(f"{t:%Y-%m-%d %H:00} {price:.3f} {color}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import getopt
+import sys
+from datetime import datetime
+import hass
+import spot_price
+
+# Lamp n shows the price color of the hour n - 1 hours from now through
+# scene.lampa_<n>_<color>, and is turned off at night.
+LIGHTS = [
+    "ikea_of_sweden_tradfri_bulb_e27_cws_globe_806lm_light",
+    "ikea_of_sweden_tradfri_bulb_e27_cws_globe_806lm_light_2",
+    "ikea_of_sweden_tradfri_bulb_e27_cws_globe_806lm_light_3",
+]
+OFF_HOUR = 23
+ON_HOUR = 6
+
+# Returns { light: (domain, service, entity ID) } for the given hour. The
+# state is kept per light, so a lamp turned off at night is turned on again
+# in the morning even if its color is the same as the evening before.
+def desired_states(hour, prices):
+    if hour >= OFF_HOUR or hour < ON_HOUR:
+        print(f"Lights off at hour {hour}")
+        return { light: ("light", "turn_off", "light." + light) for light in LIGHTS }
+
+    colors = [color for _, _, color in prices.hours(len(LIGHTS))]
+    print(f"Colors: {' '.join(colors)}")
+    return { light: ("scene", "turn_on", f"scene.lampa_{n}_{color}") for n, (light, color) in enumerate(zip(LIGHTS, colors), 1) }
+
+def usage():
+    print(f"{sys.argv[0]} [-h][-f] [-s spot price source]")
+    print(f"\t-f  : send all lamp states, not only the changed ones")
+    print(f"\t-s  : spot price API base URL, local directory or JSON file (default {spot_price.SOURCE})")
+    print(f"\t-h  : show this help")
+
+def main():
+    force = False
+    prices = spot_price.SpotPrices()
+    optss, args = getopt.getopt(sys.argv[1:], 'hfs:')
+    for o, a in optss:
+        if o == "-f":
+            force = True
+        elif o == "-s":
+            prices.source = a
+        elif o == "-h":
+            usage()
+            sys.exit(2)
+
+    desired = desired_states(datetime.now().hour, prices)
+    client = hass.Client.from_config()
+    try:
+        changed = client.apply(desired, force)
+    finally:
+        client.close()
+    print(f"Changed: {', '.join(changed) if changed else 'nothing'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import math
+
+# Compression of time series, for recording only the points needed to
+# reconstruct a signal within a given deviation. Each compressor takes the
+# points of one series through add(), which returns the points to record
+# (possibly none), and flush(), which returns the last point if it hasn't
+# been recorded yet.
+
+# Records a point when its value differs more than deviation from the last
+# recorded value.
+class Deadband:
+    def __init__(self, deviation):
+        self.deviation = deviation
+        self.recorded = None
+        self.last = None
+
+    def add(self, t, value):
+        self.last = (t, value)
+        if self.recorded is None or not isCloseTo(value, self.recorded[1], self.deviation):
+            self.recorded = self.last
+            return [self.last]
+        return []
+
+    def flush(self):
+        if self.last is not None and self.last != self.recorded:
+            self.recorded = self.last
+            return [self.last]
+        return []
+
+# Swinging door trending: a point is recorded when a straight line from the
+# last recorded point can no longer pass within deviation of every point
+# since. The line then ends at the previous point, so peaks and turning
+# points are kept while linear stretches collapse to their end points.
+class SwingingDoor:
+    def __init__(self, deviation):
+        self.deviation = deviation
+        self.recorded = None
+        self.last = None
+
+    def restart(self, point):
+        self.recorded = point
+        self.upper = math.inf
+        self.lower = -math.inf
+
+    def narrow(self, t, value):
+        t0, v0 = self.recorded
+        dt = t - t0
+        self.upper = min(self.upper, (value + self.deviation - v0) / dt)
+        self.lower = max(self.lower, (value - self.deviation - v0) / dt)
+
+    def add(self, t, value):
+        point = (t, value)
+        if self.recorded is None or not (math.isfinite(value) and math.isfinite(self.recorded[1])):
+            # first point, or to or from a missing value: end the current line and record as is
+            result = self.flush() + [point]
+            self.restart(point)
+            self.last = point
+            return result
+        if t <= self.last[0]:
+            # same time as, or a clock step back from, the last point: the
+            # slopes from it would be infinite or wrong, drop the point
+            return []
+
+        result = []
+        self.narrow(t, value)
+        if self.lower > self.upper:
+            # the door closed, record the previous point and start over from it
+            result.append(self.last)
+            self.restart(self.last)
+            self.narrow(t, value)
+        self.last = point
+        return result
+
+    def flush(self):
+        if self.last is not None and self.last is not self.recorded:
+            self.restart(self.last)
+            return [self.last]
+        return []
+
+def isCloseTo(value, other, deviation):
+    if not (math.isfinite(value) and math.isfinite(other)):
+        return value == other or (math.isnan(value) and math.isnan(other))
+    return abs(value - other) <= deviation
+
+COMPRESSORS = {
+    "deadband": Deadband,
+    "swingingdoor": SwingingDoor,
+}
@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+try:
+    import slimmelezer
+except ImportError:
+    slimmelezer = None
+
+@unittest.skipIf(slimmelezer is None, "aioesphomeapi is not installed")
+class WatchdogTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(slimmelezer.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.watchdog = slimmelezer.Watchdog("energy", ["power", "power_phase_1"], 20, 60)
+
+    def test_subscribed_then_silent_is_stale(self):
+        self.watchdog.subscribed(["power", "power_phase_1", "energy", "voltage"])
+        self.now += 30
+        self.assertEqual(self.watchdog.stale(), [])
+        self.now += 31
+        self.assertEqual(sorted(self.watchdog.stale()), ["energy", "power", "power_phase_1"])
+
+    def test_object_ids_the_device_lacks_are_not_stale(self):
+        self.watchdog.subscribed(["power"])
+        self.now += 61
+        self.assertEqual(self.watchdog.stale(), ["power"])
+
+    def test_updates_keep_it_fresh(self):
+        self.watchdog.subscribed(["power", "energy"])
+        self.now += 50
+        self.watchdog.update("power", 1.0)
+        self.watchdog.update("energy", 2.0)
+        self.now += 50
+        self.assertEqual(self.watchdog.stale(), [])
+
+    def test_not_stale_before_subscribing(self):
+        self.now += 1000
+        self.assertEqual(self.watchdog.stale(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+import swingingdoor
+
+# Feeds the points through a compressor and returns everything it records.
+def compress(compressor, points):
+    recorded = []
+    for t, value in points:
+        recorded += compressor.add(t, value)
+    return recorded + compressor.flush()
+
+class SwingingDoorTest(unittest.TestCase):
+    def test_linear_stretch_keeps_end_points(self):
+        points = [(t, 2.0 * t) for t in range(10)]
+        self.assertEqual(compress(swingingdoor.SwingingDoor(0.1), points), [(0, 0.0), (9, 18.0)])
+
+    def test_equal_timestamp_after_door_closes(self):
+        # the door closes at (3, 0), then (3, 5) used to divide by zero
+        points = [(0, 0.0), (1, 1.0), (2, 2.0), (3, 0.0), (3, 5.0)]
+        self.assertEqual(compress(swingingdoor.SwingingDoor(0.1), points), [(0, 0.0), (2, 2.0), (3, 0.0)])
+
+    def test_decreasing_timestamps_are_dropped(self):
+        points = [(0, 0.0), (1, 1.0), (2, 2.0), (1.5, 9.0), (3, 3.0)]
+        self.assertEqual(compress(swingingdoor.SwingingDoor(0.1), points), [(0, 0.0), (3, 3.0)])
+
+    def test_recorded_times_increase(self):
+        points = [(0, 0.0), (1, 5.0), (1, 6.0), (0.5, 1.0), (2, 0.0), (2, 3.0), (3, 3.0)]
+        times = [t for t, _ in compress(swingingdoor.SwingingDoor(0.1), points)]
+        self.assertEqual(times, sorted(set(times)))
+
+class DeadbandTest(unittest.TestCase):
+    def test_equal_timestamps(self):
+        points = [(0, 0.0), (1, 0.05), (1, 1.0), (1, 1.0)]
+        self.assertEqual(compress(swingingdoor.Deadband(0.1), points), [(0, 0.0), (1, 1.0)])
+
+if __name__ == "__main__":
+    unittest.main()